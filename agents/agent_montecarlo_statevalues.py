@@ -8,18 +8,22 @@ from .agent import AgentDiscrete
 class AgentMonteCarloV(AgentDiscrete):
 
     """Implementation of an agent that learns V values for a random policy.
+
+    The values are stored with the given dtype, e.g. np.float32 to halve
+    their memory. The returns are summed, and averaged, in float64.
     """
 
-    def __init__(self, num_states, num_actions, alpha=0.2, beta=0.95):
+    def __init__(self, num_states, num_actions, alpha=0.2, beta=0.95,
+                 dtype=np.float64):
 
         # I have kept this compatible with both Python 2 and 3
         AgentDiscrete.__init__(self, num_states, num_actions)
 
         # Structure for storing the state values
-        self._V = np.zeros((num_states,))  # Initialize values to 0
+        self._V = np.zeros((num_states,), dtype=dtype)  # Initialize to 0
 
         # Later on for state/action values (Q), you will need something like:
-        self._Q = np.zeros((num_states, num_actions))  # Initialize Q-values
+        self._Q = np.zeros((num_states, num_actions), dtype=dtype)
 
         # ANYTHING TO CODE HERE?
         # Any other things the agent needs to store to compute values?
@@ -39,10 +43,10 @@ class AgentMonteCarloV(AgentDiscrete):
     def learn(self):
         """ Inform the agent that a new episode has started. """
         # ANYTHING TO CODE HERE?
-        R = 0
-        for o, r, a in reversed(zip(self.observations,
-                                    self.rewards,
-                                    self.actions)):
+        R = 0.0  # A Python float, so returns are summed in float64
+        for o, r, a in reversed(list(zip(self.observations,
+                                         self.rewards,
+                                         self.actions))):
             R += r
             self.results[o][a].append(R)
 
@@ -50,7 +54,8 @@ class AgentMonteCarloV(AgentDiscrete):
             for j, res in enumerate(result_list):
                 if res:
                     self._Q[i, j] = self.alpha*(np.mean(res)-self._Q[i, j])
-            self._V[i] += self.alpha*(np.mean(self._Q[i, :])-self._V[i])
+            self._V[i] += self.alpha*(np.mean(self._Q[i, :], dtype=np.float64)
+                                      - self._V[i])
 
     def newEpisode(self):
         # Reset the memorised policy history
@@ -0,0 +1,103 @@
+import time
+
+import numpy as np
+import scipy.sparse
+
+from dynamic_programming import valueIteration
+from mdps.mdp_grid import MDPGrid
+
+
+def timeCall(function, *args, **kwargs):
+    """ Call a function and measure how long it takes.
+
+    Returns a tuple with:
+        the return value of the function
+        the wall time of the call, in seconds
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return (result, time.perf_counter() - start)
+
+
+def benchmarkParallel(mdp, worker_counts, n_iterations=100):
+    """ Compare the wall time of value iteration with different numbers of
+    worker processes.
+
+    Args:
+        mdp - a MarkovDecisionProcess
+        worker_counts - a list of numbers of workers
+        n_iterations - the number of sweeps, which are all performed
+    """
+    # epsilon=0 makes all runs perform the same number of sweeps
+    ((V_serial, _), t_serial) = timeCall(
+        valueIteration, mdp, n_iterations=n_iterations, epsilon=0.0)
+    print('{: >8} {: >10.3f}s'.format('serial', t_serial))
+
+    for n_workers in worker_counts:
+        ((V, _), t) = timeCall(valueIteration, mdp, n_iterations=n_iterations,
+                               epsilon=0.0, n_workers=n_workers)
+        print('{: >8} {: >10.3f}s  speedup {: >5.2f}  max diff {:.1e}'.format(
+            n_workers, t, t_serial / t, np.max(np.abs(V - V_serial))))
+
+
+def tableBytes(table):
+    """ Return the memory used by a numpy array or scipy.sparse CSR matrix,
+    in bytes.
+    """
+    if table is None:
+        return 0
+    if scipy.sparse.issparse(table):
+        return table.data.nbytes + table.indices.nbytes + table.indptr.nbytes
+    return table.nbytes
+
+
+def benchmarkDtypes(size, dtypes, n_iterations=100, sparse=True):
+    """ Compare the memory and the wall time of value iteration on a grid
+    stored with different floating point types.
+
+    The memory is that of P, R, the expected rewards and the values, which
+    are all the arrays that a sweep reads.
+
+    Args:
+        size - the number of rows and columns of the grid
+        dtypes - a list of numpy floating point types, the first one being
+            the reference for the differences of the values
+        n_iterations - the number of sweeps, which are all performed
+        sparse - whether the grid is stored sparsely
+    """
+    V_reference = None
+    for dtype in dtypes:
+        mdp = MDPGrid(size, size, 0.1, 0.99, sparse=sparse, dtype=dtype)
+        ((V, _), t) = timeCall(valueIteration, mdp, n_iterations=n_iterations,
+                               epsilon=0.0)
+        n_bytes = tableBytes(mdp.P) + tableBytes(mdp.R) + \
+            tableBytes(mdp.expectedRewards()) + tableBytes(V)
+        if V_reference is None:
+            V_reference = V
+        print('{: >8} {: >10.1f}MB {: >10.3f}s  max diff {:.1e}'.format(
+            np.dtype(dtype).name, n_bytes / 1e6, t,
+            np.max(np.abs(V.astype(np.float64) - V_reference))))
+
+
+if __name__ == '__main__':
+
+    import multiprocessing
+    import sys
+    if (len(sys.argv) < 2):
+        size = 300
+    else:
+        size = int(sys.argv[1])
+
+    mdp = MDPGrid(size, size, 0.1, 1.0, sparse=True)
+
+    print("________________________________________________________")
+    print("Parallel value iteration on a " + str(size) + "x" + str(size) +
+          " grid.")
+    n_cpus = multiprocessing.cpu_count()
+    worker_counts = [n for n in [1, 2, 4, 8, 16] if n <= n_cpus]
+    benchmarkParallel(mdp, worker_counts)
+
+    print("________________________________________________________")
+    print("Value iteration with float64 and float32 values on a " + str(size) +
+          "x" + str(size) + " grid.")
+    benchmarkDtypes(size, [np.float64, np.float32])
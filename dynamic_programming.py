@@ -1,10 +1,397 @@
+import heapq
+import os
 import random
+import time
+import warnings
 import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
 
 import mdps
 
+# Largest number of states for which the linear system of an exact policy
+# evaluation is factorized. Larger systems are solved with a Krylov method.
+DENSE_SOLVE_MAX_STATES = 2000
+SPARSE_SOLVE_MAX_STATES = 200000
 
-def policyEvaluation(mdp, policy, n_iterations=1000, verbose=False, ax=None):
+
+class SolverTrace:
+
+    """ Record of the progress of a solver, iteration by iteration.
+
+    Pass an instance as the 'trace' argument of a solver to inspect its
+    convergence afterwards. What an iteration is depends on the solver: a
+    sweep for value iteration and policy evaluation, a policy improvement for
+    policy iteration, and len(S) backups for prioritized sweeping.
+    """
+
+    def __init__(self):
+        self.residuals = []  # Largest change of a value, per iteration
+        self.times = []  # Wall time of each iteration, in seconds
+        self.n_backups = []  # Single-state backups, per iteration
+        self.stopped = False  # Whether the callback stopped the solver
+        self._callback = None
+        self._last_time = None
+
+    def start(self, callback=None):
+        """ Clear the trace, and start timing a new solve.
+
+        Args:
+            callback - (optional) a function callback(iteration, V, residual)
+                called after every iteration. If it returns True, the solver
+                stops early.
+        """
+        del self.residuals[:]
+        del self.times[:]
+        del self.n_backups[:]
+        self.stopped = False
+        self._callback = callback
+        self._last_time = time.perf_counter()
+
+    def record(self, V, residual, n_backups):
+        """ Record an iteration of the solver.
+
+        Args:
+            V - the values after the iteration
+            residual - the largest change of a value during the iteration
+            n_backups - the number of single-state backups it performed
+
+        Returns:
+            True if the callback asks the solver to stop, False otherwise
+
+        The callback gets a copy of V: solvers update their values in place,
+        or keep them in memory that is freed after the solve.
+        """
+        self.times.append(time.perf_counter() - self._last_time)
+        self.residuals.append(residual)
+        self.n_backups.append(n_backups)
+
+        stop = False
+        if self._callback is not None:
+            stop = bool(self._callback(len(self.residuals), np.array(V),
+                                       residual))
+            self.stopped = self.stopped or stop
+        # The time spent in the callback is not part of the next iteration
+        self._last_time = time.perf_counter()
+        return stop
+
+    def numIterations(self):
+        """ Return the number of recorded iterations."""
+        return len(self.residuals)
+
+    def totalTime(self):
+        """ Return the wall time of all recorded iterations, in seconds."""
+        return sum(self.times)
+
+    def backupsPerSecond(self):
+        """ Return the number of single-state backups per second."""
+        total_time = self.totalTime()
+        if total_time == 0:
+            return float('nan')
+        return sum(self.n_backups) / total_time
+
+    def __str__(self):
+        string = '{} iterations, {} backups in {:.3f}s'.format(
+            self.numIterations(), sum(self.n_backups), self.totalTime())
+        string += ' ({:.3g} backups/s)'.format(self.backupsPerSecond())
+        if self.residuals:
+            string += ', final residual {:.3g}'.format(self.residuals[-1])
+        return string
+
+
+def _tolerance(V, epsilon):
+    """ Return the residual below which sweeps stop.
+
+    A float32 value has about 7 significant digits, so its changes cannot be
+    resolved below a few units in its last place. A smaller epsilon is
+    raised to that resolution, so that the sweeps stop instead of running
+    until n_iterations on rounding noise.
+    """
+    resolution = 4 * np.finfo(V.dtype).eps * np.max(np.abs(V), initial=0.0)
+    return max(epsilon, resolution)
+
+
+def _startTrace(trace, callback):
+    """ Start the trace of a solver, creating one if none was given."""
+    if trace is None:
+        trace = SolverTrace()
+    trace.start(callback)
+    return trace
+
+
+def _actionValues(mdp, V, rewards, start=0, stop=None):
+    """ Compute the action values of a contiguous block of states.
+
+    Q(s,a) = r(s,a) + discount * sum_s' P(s,a,s') * V(s')
+
+    Args:
+        mdp - a MarkovDecisionProcess
+        V - the current values, a numpy array of size len(S)
+        rewards - the expected rewards r(s,a), see
+            MarkovDecisionProcess.expectedRewards()
+        start, stop - the block of states to back up (default: all of them)
+
+    Returns:
+        the action values, a numpy array of size (stop-start) X len(A)
+    """
+    if stop is None:
+        stop = len(mdp.S)
+    return rewards[start:stop] + \
+        mdp.discount * mdp.expectedNextValues(V, start, stop)
+
+
+def _stateActionValues(mdp, V, rewards, states):
+    """ Compute the action values of an arbitrary set of states.
+
+    Args:
+        mdp - a MarkovDecisionProcess
+        V - the current values, a numpy array of size len(S)
+        rewards - the expected rewards r(s,a), see
+            MarkovDecisionProcess.expectedRewards()
+        states - the states to back up, a numpy array of ints
+
+    Returns:
+        the action values, a numpy array of size len(states) X len(A)
+    """
+    n_actions = len(mdp.A)
+    (next_states, probabilities, _) = mdp.batchSuccessors(
+        np.repeat(states, n_actions), np.tile(np.arange(n_actions),
+                                              len(states)))
+    expected_values = np.sum(probabilities * V[next_states], axis=1)
+    return rewards[states] + \
+        mdp.discount * expected_values.reshape(len(states), n_actions)
+
+
+def _bellmanSweep(mdp, V, backup, rewards, sweep='jacobi', block_size=64):
+    """ Perform one Bellman backup of all the states.
+
+    Args:
+        mdp - a MarkovDecisionProcess
+        V - the current values, a numpy array of size len(S)
+        backup - a function (Q, start, stop) -> values, which reduces the
+            action values of a block of states to their new values
+        rewards - the expected rewards r(s,a), see
+            MarkovDecisionProcess.expectedRewards()
+        sweep - 'jacobi' backs up all states from the values of the previous
+            sweep in one operation. 'gauss-seidel' backs up the states block
+            by block, in place, so that later blocks already use the new
+            values of earlier blocks.
+        block_size - number of states per block for 'gauss-seidel' sweeps.
+            A block size of 1 is the classical state-by-state update.
+
+    Returns a tuple with:
+        the new values, a numpy array of size len(S)
+        the residual, i.e. the largest absolute change of a value
+    """
+    n_states = len(mdp.S)
+
+    if sweep == 'jacobi':
+        V_new = backup(_actionValues(mdp, V, rewards), 0, n_states)
+        V_new = V_new.astype(V.dtype, copy=False)
+        return (V_new, np.max(np.abs(V_new - V)))
+
+    if sweep == 'gauss-seidel':
+        residual = 0.0
+        for start in range(0, n_states, block_size):
+            stop = min(start + block_size, n_states)
+            values = backup(_actionValues(mdp, V, rewards, start, stop),
+                            start, stop)
+            residual = max(residual, np.max(np.abs(values - V[start:stop])))
+            V[start:stop] = values
+        return (V, residual)
+
+    raise ValueError('Unknown sweep "' + str(sweep) + '"')
+
+
+def _iterateSweeps(mdp, V, backup, rewards, n_iterations, epsilon, sweep,
+                   block_size, trace=None):
+    """ Repeat Bellman sweeps until the residual drops below epsilon.
+
+    Each sweep is recorded in the trace, if one is given.
+
+    Returns a tuple with:
+        the values, a numpy array of size len(S)
+        the residual of the last sweep
+    """
+    n_states = len(mdp.S)
+    residual = np.inf
+    for _ in range(n_iterations):
+        (V, residual) = _bellmanSweep(mdp, V, backup, rewards, sweep,
+                                      block_size)
+        if trace is not None and trace.record(V, residual, n_states):
+            break
+        if residual < _tolerance(V, epsilon):
+            break
+    return (V, residual)
+
+
+def _greedyActions(Q, actions=None):
+    """ Determine the greedy action in each state.
+
+    Args:
+        Q - the action values, a numpy array of size len(S) X len(A)
+        actions - (optional) the current actions, a numpy array of ints of
+            size len(S). They are kept if they are still greedy, so that
+            ties do not make a policy flip between equally good actions.
+
+    Returns:
+        the greedy actions, a numpy array of ints of size len(S)
+    """
+    greedy = np.argmax(Q, axis=1)
+    if actions is not None:
+        states = np.arange(len(Q))
+        Q_max = Q[states, greedy]
+        precision = max(1e-9, 8 * np.finfo(Q.dtype).eps)
+        tolerance = precision * np.maximum(1.0, np.abs(Q_max))
+        is_tie = Q[states, actions] >= Q_max - tolerance
+        greedy = np.where(is_tie, actions, greedy)
+    return greedy
+
+
+def _uniformPolicy(mdp):
+    """ Return the policy that picks all actions with the same probability,
+    a numpy array of size len(S) X len(A).
+    """
+    n_actions = len(mdp.A)
+    return np.full((len(mdp.S), n_actions), 1.0 / n_actions, dtype=mdp.dtype)
+
+
+def _deterministicPolicy(actions, n_actions, dtype=np.float64):
+    """ Convert one action per state to a policy matrix.
+
+    Returns:
+        the policy, a numpy array of size len(S) X len(A), with a probability
+        of 1 for the given action of each state and 0 for the others
+    """
+    policy = np.zeros((len(actions), n_actions), dtype=dtype)
+    policy[np.arange(len(actions)), actions] = 1.0
+    return policy
+
+
+def _policyTransitions(mdp, policy, rewards):
+    """ Compute the transitions and rewards of the Markov chain of a policy.
+
+    P_pi(s,s') = sum_a policy(s,a) * P(s,a,s')
+    r_pi(s)    = sum_a policy(s,a) * r(s,a)
+
+    Returns a tuple with:
+        P_pi, a numpy array or scipy.sparse CSR matrix of size len(S) X len(S)
+        r_pi, a numpy array of size len(S)
+    """
+    n_states = len(mdp.S)
+    n_actions = len(mdp.A)
+    r_pi = np.sum(policy * rewards, axis=1)
+    P = mdp.transitionMatrix()
+    if not scipy.sparse.issparse(P):
+        return (np.einsum('ij,ijk->ik', policy,
+                          P.reshape(n_states, n_actions, n_states)), r_pi)
+
+    # Row s of the weights holds policy(s,.) in the columns s*len(A)+a, so
+    # that multiplying it with the transition matrix averages over actions.
+    weights = scipy.sparse.csr_matrix(
+        (policy.ravel(), np.arange(n_states * n_actions),
+         np.arange(0, n_states * n_actions + 1, n_actions)),
+        shape=(n_states, n_states * n_actions))
+    return (weights.dot(P).tocsr(), r_pi)
+
+
+def _solvePolicyValues(mdp, policy, rewards, V, n_iterations, epsilon):
+    """ Solve the Bellman equations (I - discount*P_pi) V = r_pi of a policy.
+
+    Small systems are factorized, with a dense or sparse solver depending on
+    how P is stored. Larger ones are solved with BiCGSTAB, a Krylov method,
+    which starts from the values V. The system is always solved in float64,
+    and the values are then converted to the dtype of the MDP.
+
+    Raises:
+        numpy.linalg.LinAlgError if the system is singular, e.g. when the
+        discount is 1 and the policy never reaches a terminal state, or if
+        the Krylov method does not converge.
+    """
+    n_states = len(mdp.S)
+    (P_pi, r_pi) = _policyTransitions(mdp, policy, rewards)
+
+    if scipy.sparse.issparse(P_pi):
+        system = scipy.sparse.identity(n_states, format='csc') - \
+            mdp.discount * P_pi.tocsc().astype(np.float64)
+        max_states = SPARSE_SOLVE_MAX_STATES
+    else:
+        system = np.identity(n_states) - mdp.discount * P_pi.astype(np.float64)
+        max_states = DENSE_SOLVE_MAX_STATES
+
+    if n_states > max_states:
+        (V, info) = scipy.sparse.linalg.bicgstab(
+            system, r_pi.astype(np.float64), x0=V.astype(np.float64),
+            rtol=0.0, atol=epsilon,
+            maxiter=n_iterations)
+        if info != 0:
+            raise np.linalg.LinAlgError(
+                'BiCGSTAB did not converge (info=' + str(info) + ')')
+    elif scipy.sparse.issparse(system):
+        # A singular system is reported by the check on V below.
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore',
+                                  scipy.sparse.linalg.MatrixRankWarning)
+            V = scipy.sparse.linalg.spsolve(system, r_pi.astype(np.float64))
+    else:
+        V = np.linalg.solve(system, r_pi.astype(np.float64))
+
+    if not np.all(np.isfinite(V)):
+        raise np.linalg.LinAlgError('Bellman equations are singular')
+    return V.astype(mdp.dtype)
+
+
+def _evaluatePolicy(mdp, policy, rewards, V, n_iterations, epsilon, method,
+                    sweep, block_size, trace=None):
+    """ Determine the values of a policy, starting from the values V.
+
+    See policyEvaluation() for the arguments. An exact solution is recorded
+    in the trace as a single iteration.
+
+    Returns a tuple with:
+        the values, a numpy array of size len(S)
+        the residual of the last sweep, or 0 for an exact solution
+    """
+    if method in ('direct', 'auto'):
+        try:
+            V = _solvePolicyValues(mdp, policy, rewards, V, n_iterations,
+                                   epsilon)
+            if trace is not None:
+                trace.record(V, 0.0, len(mdp.S))
+            return (V, 0.0)
+        except np.linalg.LinAlgError:
+            if method == 'direct':
+                raise
+    elif method != 'iterative':
+        raise ValueError('Unknown method "' + str(method) + '"')
+
+    # The new value of a state is the policy-weighted mean of its Q-values.
+    def backup(Q, start, stop):
+        return np.sum(policy[start:stop] * Q, axis=1)
+
+    # Without discount, a residual r can leave an error of r times the
+    # number of steps to a terminal state. float32 values stop changing at
+    # a residual of a few units in their last place, which can then leave an
+    # error of about 1e-3 of the values, so the sweeps accumulate in float64.
+    (V, residual) = _iterateSweeps(mdp, V.astype(np.float64), backup, rewards,
+                                   n_iterations, epsilon, sweep, block_size,
+                                   trace)
+    return (V.astype(mdp.dtype), residual)
+
+
+def _initialValues(mdp, initial_values):
+    """ Return a copy of the initial values, or zeros if there are none, in
+    the dtype of the MDP.
+    """
+    if initial_values is None:
+        return np.zeros((len(mdp.S),), dtype=mdp.dtype)
+    return np.array(initial_values, dtype=mdp.dtype)
+
+
+def policyEvaluation(mdp, policy, n_iterations=1000, verbose=False, ax=None,
+                     epsilon=0.01, sweep='jacobi', block_size=64,
+                     method='iterative', initial_values=None, cache=None,
+                     trace=None, callback=None):
     """ Perform policy evaluation, i.e. determine the values given a policy.
 
     Args:
@@ -13,6 +400,24 @@ def policyEvaluation(mdp, policy, n_iterations=1000, verbose=False, ax=None):
         n_iterations - the number of iterations to run the algorithm
         verbose - whether to print intermediate results
         ax - if this is a matplotlib axes, you can plot on it
+        epsilon - stop when no value changes more than this during a sweep
+        sweep - 'jacobi' or 'gauss-seidel', see _bellmanSweep()
+        block_size - number of states per block for 'gauss-seidel' sweeps
+        method - 'iterative' repeats Bellman sweeps. 'direct' solves the
+            Bellman equations of the policy as a linear system, which gives
+            the exact values. 'auto' tries 'direct', and falls back to
+            'iterative' if the system cannot be solved.
+        initial_values - (optional) values to start iterating from, a numpy
+            array of size len(S). Zero if not given.
+        cache - (optional) a SolutionCache. If it already holds the values
+            for these arguments, they are returned without solving anything.
+            If it holds the values for another discount factor, they are used
+            as initial values. Values stopped early by the callback are not
+            stored.
+        trace - (optional) a SolverTrace, in which the residual, wall time
+            and number of backups of each sweep are recorded
+        callback - (optional) a function callback(iteration, V, residual),
+            called after each sweep. The solver stops if it returns True.
 
     Returns:
         the values, a numpy array of size len(S)
@@ -23,33 +428,107 @@ def policyEvaluation(mdp, policy, n_iterations=1000, verbose=False, ax=None):
     n_states = len(mdp.S)
     n_actions = len(mdp.A)
 
+    if cache is not None:
+        key = cache.key('policyEvaluation', mdp, policy, {
+            'n_iterations': n_iterations, 'epsilon': epsilon, 'sweep': sweep,
+            'block_size': block_size, 'method': method})
+        solution = cache.load(key)
+        if solution is not None:
+            return solution[0]
+        if initial_values is None:
+            initial_values = cache.warmStart(key)
+
     # V contains the values
-    V = np.zeros((n_states,))
+    V = _initialValues(mdp, initial_values)
 
     # Here are some functions that may be useful for print debugging and plots.
-    print(mdp.policyString(policy) + '\n')
-    print(mdp.valuesString(V) + '\n')
+    # Rendering large MDPs as strings can take longer than solving them, so
+    # only do so when asked.
+    if verbose:
+        print(mdp.policyString(policy) + '\n')
+        print(mdp.valuesString(V) + '\n')
     if ax:
         mdp.plotValues(ax, V, policy)
 
-    # IMPLEMENT POLICY EVALUATION HERE
-    epsilon = 0.01
-    for _ in range(n_iterations):
-        delta = 0
-        for i, state in enumerate(mdp.S):
-            value = V[i]
-            tmp = np.sum(mdp.P[i]*(mdp.R[i]+mdp.discount*V), axis=1)
-            V[i] = np.sum(policy[i]*tmp)
-            delta = max(delta, value - V[i])
-        if delta < epsilon:
-            break
+    trace = _startTrace(trace, callback)
+    (V, _) = _evaluatePolicy(mdp, np.asarray(policy), mdp.expectedRewards(),
+                             V, n_iterations, epsilon, method, sweep,
+                             block_size, trace)
+
+    if verbose:
+        print('Policy evaluation: ' + str(trace) + '\n')
+
+    # The values of a solve stopped by the callback are not the solution
+    if cache is not None and not trace.stopped:
+        cache.save(key, V)
 
     # Return values for the policy
     return V
 
 
+def batchPolicyEvaluation(mdp, policies, discounts=None, n_iterations=1000,
+                          epsilon=0.01, trace=None, callback=None):
+    """ Evaluate several policies, with several discount factors, at once.
+
+    All members of the batch are backed up with a single pass over the
+    transition function per sweep, instead of one pass per member.
+
+    Args:
+        mdp - a MarkovDecisionProcess
+        policies - the policies, a numpy array of size B X len(S) X len(A)
+        discounts - (optional) the discount factor of each policy, a number or
+            a numpy array of size B. Default: the discount factor of the MDP.
+        n_iterations - the maximum number of sweeps
+        epsilon - a member has converged when none of its values changes
+            more than this during a sweep. It is not updated anymore then.
+        trace - (optional) a SolverTrace, see policyEvaluation(). The
+            residual of a sweep is the largest one over the batch.
+        callback - (optional) a function callback(iteration, V, residual),
+            see policyEvaluation(). V is the B X len(S) array of values.
+
+    Returns a tuple with:
+        the values, a numpy array of size B X len(S)
+        whether each member converged, a numpy array of booleans of size B
+
+    """
+    n_states = len(mdp.S)
+    n_actions = len(mdp.A)
+    policies = np.asarray(policies, dtype=mdp.dtype)
+    n_members = len(policies)
+    if discounts is None:
+        discounts = mdp.discount
+    discounts = np.broadcast_to(np.asarray(discounts, dtype=float),
+                                (n_members,))
+
+    rewards = mdp.expectedRewards()
+
+    trace = _startTrace(trace, callback)
+    # The sweeps accumulate in float64, as in _evaluatePolicy()
+    V = np.zeros((n_members, n_states))
+    converged = np.zeros(n_members, dtype=bool)
+    for _ in range(n_iterations):
+        active = np.flatnonzero(~converged)
+        if len(active) == 0:
+            break
+
+        # One product of P with all active value functions: len(S) X len(A) X B
+        Q = rewards[:, :, None] + discounts[active] * \
+            mdp.expectedNextValues(V[active].T)
+        V_new = np.einsum('bij,ijb->bi', policies[active], Q)
+
+        residuals = np.max(np.abs(V_new - V[active]), axis=1)
+        V[active] = V_new
+        converged[active] = residuals < _tolerance(V, epsilon)
+        if trace.record(V, np.max(residuals), len(active) * n_states):
+            break
+
+    return (V.astype(mdp.dtype), converged)
+
+
 def valueIteration(mdp, policy=None, n_iterations=1000, verbose=False,
-                   ax=None):
+                   ax=None, epsilon=0.01, sweep='jacobi', block_size=64,
+                   n_workers=None, initial_values=None, cache=None,
+                   trace=None, callback=None):
     """ Perform value iteration, i.e. determine the optimal and values.
 
     Args:
@@ -58,10 +537,28 @@ def valueIteration(mdp, policy=None, n_iterations=1000, verbose=False,
         n_iterations - the number of iterations to run the algorithm
         verbose - whether to print intermediate results
         ax - if this is a matplotlib axes, you can plot on it
+        epsilon - stop when no value changes more than this during a sweep
+        sweep - 'jacobi' or 'gauss-seidel', see _bellmanSweep(), or
+            'stencil' for Jacobi sweeps of an MDPGrid as 2D array
+            operations, which never read P. See dynamic_programming_stencil.
+        block_size - number of states per block for 'gauss-seidel' sweeps
+        n_workers - if given, split each sweep over this many processes,
+            which share the MDP in memory. Sweeps are then always 'jacobi'.
+            This is only faster with free cores for all the workers, see
+            dynamic_programming_parallel.
+        initial_values - (optional) values to start iterating from, a numpy
+            array of size len(S). Zero if not given.
+        cache - (optional) a SolutionCache, see policyEvaluation()
+        trace - (optional) a SolverTrace, see policyEvaluation()
+        callback - (optional) a function callback(iteration, V, residual),
+            see policyEvaluation()
 
     Returns a tuple with:
         the (optimal) values, a numpy array of size len(S)
-        the (optimal) policy, a numpy array of size len(S) X len(A)
+        the (optimal) policy, a numpy array of size len(S) X len(A). It is
+        deterministic: the greedy action of each state has probability 1.
+        Ties are resolved in favour of the most likely action of the initial
+        policy.
 
     """
 
@@ -71,28 +568,511 @@ def valueIteration(mdp, policy=None, n_iterations=1000, verbose=False,
     # If no policy is passed, initialize a random one.
     if policy is None:
         # Initialize random policy
-        policy = np.full((n_states, n_actions), 1.0 / n_actions)
+        policy = _uniformPolicy(mdp)
+
+    if cache is not None:
+        key = cache.key('valueIteration', mdp, policy, {
+            'n_iterations': n_iterations, 'epsilon': epsilon, 'sweep': sweep,
+            'block_size': block_size})
+        solution = cache.load(key)
+        if solution is not None:
+            return solution
+        if initial_values is None:
+            initial_values = cache.warmStart(key)
 
     # V contains the values
-    V = np.zeros((n_states,))
+    V = _initialValues(mdp, initial_values)
+
+    # The new value of a state is its largest Q-value.
+    def backup(Q, start, stop):
+        return np.max(Q, axis=1)
+
+    trace = _startTrace(trace, callback)
+    if sweep == 'stencil':
+        from dynamic_programming_stencil import GridStencil
+        stencil = GridStencil(mdp)
+        (V, _) = stencil.iterate(V, n_iterations, epsilon, trace)
+        Q = stencil.actionValues(V.reshape(stencil.shape))
+    else:
+        rewards = mdp.expectedRewards()
+        if n_workers:
+            from dynamic_programming_parallel import parallelSweeps
+            (V, _) = parallelSweeps(mdp, V, rewards, n_iterations, epsilon,
+                                    n_workers, trace)
+        else:
+            (V, _) = _iterateSweeps(mdp, V, backup, rewards, n_iterations,
+                                    epsilon, sweep, block_size, trace)
+        Q = _actionValues(mdp, V, rewards)
+
+    if verbose:
+        print('Value iteration: ' + str(trace) + '\n')
+
+    actions = _greedyActions(Q, np.argmax(policy, axis=1))
+    policy = _deterministicPolicy(actions, n_actions, mdp.dtype)
+
+    if cache is not None and not trace.stopped:
+        cache.save(key, V, policy)
+
+    # Return (optimal?) values and (optimal?) policy
+    return (V, policy)
 
-    # IMPLEMENT VALUE ITERATION HERE
-    epsilon = 0.01
+
+def finiteHorizonValueIteration(mdp, horizon, final_values=None,
+                                verbose=False, ax=None, path=None,
+                                trace=None):
+    """ Perform backward induction, i.e. determine the optimal values and
+    policies of episodes that end after a fixed number of actions.
+
+    With a few actions left, the best action may differ from the stationary
+    one of valueIteration(): a reward that cannot be reached before the end
+    of the episode is not worth going for. The values and actions thus depend
+    on the time step t, the number of actions already performed. V[t] is
+    computed from V[t+1] with one Bellman backup of all the states, from
+    V[horizon] = final_values back to V[0].
+
+    The actions are stored as the smallest unsigned integer type that holds
+    len(A) values, i.e. one byte per state and time step for up to 256
+    actions, rather than as a policy matrix per time step. The policy of time
+    step t is _deterministicPolicy(actions[t], len(A)).
+
+    Args:
+        mdp - a MarkovDecisionProcess
+        horizon - the number of actions in an episode, e.g. the
+            max_actions_per_episode of experiment_episodic.doEpisodes()
+        final_values - (optional) the values of the states after the last
+            action, a numpy array of size len(S). Zero if not given.
+        verbose - whether to print intermediate results
+        ax - if this is a matplotlib axes, the values and policy of the first
+            time step are plotted on it
+        path - (optional) a directory in which the tables are written, as
+            values.npy and actions.npy, through memory maps. Only two time
+            steps of values are then held in memory. They can be read again
+            with numpy.load(..., mmap_mode='r').
+        trace - (optional) a SolverTrace, in which each time step is recorded
+            as one iteration, whose residual is the largest difference of a
+            value with the next time step
+
+    Returns a tuple with:
+        the values, a numpy array (or memory map) of size
+        (horizon + 1) X len(S). V[t, s] is the expected return from state s
+        when t actions have been performed.
+        the actions, a numpy array (or memory map) of unsigned ints of size
+        horizon X len(S). actions[t, s] is the optimal action in state s
+        when t actions have been performed.
+
+    """
+    n_states = len(mdp.S)
+    n_actions = len(mdp.A)
+    action_dtype = np.min_scalar_type(max(0, n_actions - 1))
+
+    if path is None:
+        values = np.empty((horizon + 1, n_states), dtype=mdp.dtype)
+        actions = np.empty((horizon, n_states), dtype=action_dtype)
+    else:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        values = np.lib.format.open_memmap(
+            os.path.join(path, 'values.npy'), mode='w+', dtype=mdp.dtype,
+            shape=(horizon + 1, n_states))
+        actions = np.lib.format.open_memmap(
+            os.path.join(path, 'actions.npy'), mode='w+', dtype=action_dtype,
+            shape=(horizon, n_states))
+
+    rewards = mdp.expectedRewards()
+    trace = _startTrace(trace, None)
+    V = _initialValues(mdp, final_values)
+    values[horizon] = V
+    next_actions = None
+    for t in range(horizon - 1, -1, -1):
+        Q = _actionValues(mdp, V, rewards)
+        # Ties keep the action of the next time step, so that the policy
+        # only changes over time where it has to.
+        next_actions = _greedyActions(Q, next_actions)
+        V_previous = V
+        V = Q[np.arange(n_states), next_actions].astype(mdp.dtype, copy=False)
+        values[t] = V
+        actions[t] = next_actions
+        trace.record(V, np.max(np.abs(V - V_previous), initial=0.0),
+                     n_states)
+
+    if path is not None:
+        values.flush()
+        actions.flush()
+
+    if verbose:
+        print('Backward induction: ' + str(trace) + '\n')
+
+    if ax and horizon > 0:
+        mdp.plotValues(ax, values[0],
+                       _deterministicPolicy(actions[0], n_actions, mdp.dtype))
+
+    return (values, actions)
+
+
+def multigridValueIteration(mdp, policy=None, n_iterations=1000,
+                            verbose=False, ax=None, epsilon=0.01, min_size=8,
+                            trace=None):
+    """ Perform value iteration on an MDPGrid from coarse to fine grids.
+
+    The grid is coarsened by a factor 2 until it is at most min_size cells
+    wide, see dynamic_programming_stencil.coarsenGrid(). A move on a grid
+    coarsened k times stands for 2^k moves on the original grid, with their
+    discount and rewards. The coarsest grid is solved first, and the values
+    of each grid, interpolated bilinearly, are the initial values of the
+    next finer one.
+
+    The coarse values are off by about one step reward, as the coarse moves
+    are twice as long, and sweeps only shrink such an error by the discount
+    factor each. So each grid is solved with 'stencil' sweeps and Newton
+    corrections, which evaluate the greedy policy exactly, see
+    GridStencil.correctedIterate(). On open grids, a few sweeps and a single
+    correction per grid then reach epsilon. Grids with thin walls, which
+    coarser grids cannot represent, take about as many sweeps as value
+    iteration.
+
+    Args:
+        mdp - an MDPGrid
+        policy - an (optional) initial policy, see valueIteration()
+        n_iterations - the maximum number of iterations per grid
+        verbose - whether to print the number of iterations per grid
+        ax - if this is a matplotlib axes, you can plot on it
+        epsilon - stop the sweeps of a grid when no value changes more than
+            this during a sweep
+        min_size - the smallest grid has at most this many rows or columns
+        trace - (optional) a SolverTrace, in which the sweeps of all grids
+            are recorded, from the coarsest to the finest grid
+
+    Returns a tuple with:
+        the (optimal) values, a numpy array of size len(S)
+        the (optimal) policy, see valueIteration()
+        the number of iterations on each grid, a list from the coarsest to
+        the original grid. An iteration is a sweep, with a correction after
+        it or not.
+
+    """
+    from dynamic_programming_stencil import GridStencil, coarsenGrid, upsample
+
+    n_states = len(mdp.S)
+    n_actions = len(mdp.A)
+    if policy is None:
+        policy = _uniformPolicy(mdp)
+
+    grids = [mdp]
+    while min(grids[-1].n_rows, grids[-1].n_cols) > min_size:
+        grids.append(coarsenGrid(grids[-1]))
+
+    trace = _startTrace(trace, None)
+    n_sweeps = []
+    V = np.zeros((len(grids[-1].S),), dtype=mdp.dtype)
+    for level in range(len(grids) - 1, -1, -1):
+        if level < len(grids) - 1:
+            V = upsample(V, grids[level + 1], grids[level])
+        stencil = GridStencil(grids[level], 2 ** level)
+        n_recorded = trace.numIterations()
+        (V, _) = stencil.correctedIterate(V, n_iterations, epsilon, trace)
+        n_sweeps.append(trace.numIterations() - n_recorded)
+        if verbose:
+            print('Multigrid level ' + str(level) + ': ' +
+                  str(grids[level].n_rows) + 'x' + str(grids[level].n_cols) +
+                  ', ' + str(n_sweeps[-1]) + ' iterations')
+
+    actions = _greedyActions(stencil.actionValues(V.reshape(stencil.shape)),
+                             np.argmax(policy, axis=1))
+    policy = _deterministicPolicy(actions, n_actions, mdp.dtype)
+
+    if ax:
+        mdp.plotValues(ax, V, policy)
+
+    return (V, policy, n_sweeps)
+
+
+def prioritizedValueIteration(mdp, max_backups=None, verbose=False, ax=None,
+                              epsilon=0.01, trace=None, callback=None):
+    """ Perform asynchronous value iteration with prioritized sweeping.
+
+    Instead of backing up all the states in every sweep, the state with the
+    largest Bellman error is backed up first. Only the predecessors of that
+    state can see their error change, so only their errors are recomputed.
+
+    Args:
+        mdp - a MarkovDecisionProcess
+        max_backups - the maximum number of single-state backups
+            (default: 1000 per state)
+        verbose - whether to print intermediate results
+        ax - if this is a matplotlib axes, you can plot on it
+        epsilon - stop when no state has a Bellman error larger than this
+        trace - (optional) a SolverTrace, see policyEvaluation(). Every
+            len(S) backups are recorded as one iteration, whose residual is
+            the largest remaining Bellman error.
+        callback - (optional) a function callback(iteration, V, residual),
+            see policyEvaluation()
+
+    Returns a tuple with:
+        the (optimal) values, a numpy array of size len(S)
+        the (optimal) policy, a deterministic numpy array of size
+        len(S) X len(A)
+        the number of single-state backups that were performed. A sweep of
+        valueIteration() performs len(S) of them.
+
+    """
+    n_states = len(mdp.S)
+    n_actions = len(mdp.A)
+    if max_backups is None:
+        max_backups = 1000 * n_states
+
+    rewards = mdp.expectedRewards()
+    predecessors = mdp.predecessors()
+
+    # Initial backed up values and Bellman errors of all the states. The
+    # backed up value of a state stays valid until one of its successors
+    # changes, and then it is recomputed along with the error.
+    V = np.zeros((n_states,), dtype=mdp.dtype)
+    targets = np.max(_actionValues(mdp, V, rewards), axis=1)
+    errors = np.abs(targets - V)
+    epsilon = _tolerance(targets, epsilon)
+
+    # Priority queue of (-error, state). heapq has no "decrease key", so an
+    # entry is stale if its error differs from the one in 'errors'.
+    queue = [(-error, s) for s, error in enumerate(errors) if error > epsilon]
+    heapq.heapify(queue)
+
+    trace = _startTrace(trace, callback)
+    n_backups = 0
+    while queue and n_backups < max_backups:
+        (error, s) = heapq.heappop(queue)
+        if -error != errors[s]:
+            continue
+
+        V[s] = targets[s]
+        errors[s] = 0.0
+        n_backups += 1
+        if n_backups % n_states == 0:
+            if trace.record(V, np.max(errors), n_states):
+                break
+
+        # Update the errors of the states that can lead to s
+        states = predecessors.indices[
+            predecessors.indptr[s]:predecessors.indptr[s + 1]]
+        if len(states) == 0:
+            continue
+        targets[states] = np.max(_stateActionValues(mdp, V, rewards, states),
+                                 axis=1)
+        for state, error in zip(states, np.abs(targets[states] - V[states])):
+            if error > epsilon:
+                errors[state] = error
+                heapq.heappush(queue, (-error, state))
+            else:
+                errors[state] = 0.0
+
+    if n_backups % n_states != 0:
+        trace.record(V, np.max(errors), n_backups % n_states)
+
+    if verbose:
+        print('Prioritized sweeping: ' + str(trace) + '\n')
+
+    actions = _greedyActions(_actionValues(mdp, V, rewards))
+    policy = _deterministicPolicy(actions, n_actions, mdp.dtype)
+
+    if ax:
+        mdp.plotValues(ax, V, policy)
+
+    return (V, policy, n_backups)
+
+
+def incrementalValueIteration(mdp, V, states=None, policy=None,
+                              n_iterations=1000, verbose=False, ax=None,
+                              epsilon=0.01, trace=None, callback=None):
+    """ Update the solution of an MDP after a local edit, e.g. with
+    MDPGrid.setWalls() or MarkovDecisionProcess.setTransitions().
+
+    Value iteration starts from the previous values, but each sweep only
+    backs up the active states: first the edited states, then the
+    predecessors of the states whose value changed by more than epsilon in
+    the previous sweep. The cost of a sweep is thus proportional to the
+    size of the region whose values change, not to the size of the MDP.
+
+    Args:
+        mdp - a MarkovDecisionProcess
+        V - the values before the edit, e.g. returned by valueIteration(). It
+            is not modified.
+        states - (optional) the edited states (default: mdp.editedStates()).
+            The edits recorded by the MDP are then cleared.
+        policy - (optional) the policy before the edit. Only the actions of
+            the states that were backed up are updated.
+        n_iterations - the maximum number of sweeps
+        verbose - whether to print intermediate results
+        ax - if this is a matplotlib axes, you can plot on it
+        epsilon - stop when no value changes more than this during a sweep.
+            The values before the edit are assumed to have converged with
+            the same epsilon.
+        trace - (optional) a SolverTrace, see policyEvaluation(). Each sweep
+            is recorded with the number of states it backed up.
+        callback - (optional) a function callback(iteration, V, residual),
+            see policyEvaluation()
+
+    Returns a tuple with:
+        the (optimal) values, a numpy array of size len(S)
+        the (optimal) policy, a deterministic numpy array of size
+        len(S) X len(A)
+        the number of single-state backups that were performed. A sweep of
+        valueIteration() performs len(S) of them.
+    """
+    n_states = len(mdp.S)
+    n_actions = len(mdp.A)
+    if states is None:
+        states = mdp.editedStates()
+        mdp.clearEdits()
+
+    rewards = mdp.expectedRewards()
+    predecessors = mdp.predecessors()
+    V = np.array(V, dtype=mdp.dtype)
+    tolerance = _tolerance(V, epsilon)
+    is_backed_up = np.zeros(n_states, dtype=bool)
+
+    trace = _startTrace(trace, callback)
+    active = np.unique(np.asarray(states, dtype=np.intp))
+    n_backups = 0
     for _ in range(n_iterations):
-        delta = 0
-        for i in range(n_states):
-            value = V[i]
-            tmp = np.sum(mdp.P[i]*(mdp.R[i]+mdp.discount*V), axis=1)
-            V[i] = np.max(tmp)
-            delta = max(delta, value - V[i])
-        if delta < epsilon:
+        if len(active) == 0:
+            break
+        V_active = np.max(_stateActionValues(mdp, V, rewards, active),
+                          axis=1).astype(V.dtype, copy=False)
+        changes = np.abs(V_active - V[active])
+        V[active] = V_active
+        is_backed_up[active] = True
+        n_backups += len(active)
+        residual = np.max(changes)
+        if trace.record(V, residual, len(active)):
             break
 
-    for i, state in enumerate(mdp.S):
-        tmp = np.sum(mdp.P[i, :, :]*(mdp.R[i, :]+mdp.discount*V), axis=1)
-        policy[i] = tmp
+        # Only the states that can lead to a changed state need a backup
+        active = np.unique(
+            predecessors[active[changes > tolerance]].indices)
+
+    if verbose:
+        print('Incremental value iteration: ' + str(trace) + '\n')
+
+    if policy is None:
+        actions = _greedyActions(_actionValues(mdp, V, rewards))
+    else:
+        actions = np.argmax(policy, axis=1)
+        states = np.flatnonzero(is_backed_up)
+        actions[states] = _greedyActions(
+            _stateActionValues(mdp, V, rewards, states), actions[states])
+    policy = _deterministicPolicy(actions, n_actions, mdp.dtype)
+
+    if ax:
+        mdp.plotValues(ax, V, policy)
+
+    return (V, policy, n_backups)
+
+
+def policyIteration(mdp, policy=None, n_iterations=100, verbose=False,
+                    ax=None, epsilon=0.01, method='auto', trace=None,
+                    callback=None):
+    """ Perform policy iteration, i.e. alternate policy evaluation and greedy
+    policy improvement until the policy does not change anymore.
+
+    Args:
+        mdp - a MarkovDecisionProcess
+        policy - an (optional) initial policy, a numpy array, size |S| X |A|
+        n_iterations - the maximum number of policy improvements
+        verbose - whether to print intermediate results
+        ax - if this is a matplotlib axes, you can plot on it
+        epsilon - precision of iterative policy evaluations
+        method - how to evaluate the policies, see policyEvaluation()
+        trace - (optional) a SolverTrace, see modifiedPolicyIteration()
+        callback - (optional) a function callback(iteration, V, residual),
+            see modifiedPolicyIteration()
+
+    Returns a tuple with:
+        the (optimal) values, a numpy array of size len(S)
+        the (optimal) policy, a deterministic numpy array of size
+        len(S) X len(A)
+
+    """
+    return modifiedPolicyIteration(mdp, None, policy, n_iterations, verbose,
+                                   ax, epsilon, method, trace, callback)
+
+
+def modifiedPolicyIteration(mdp, k=10, policy=None, n_iterations=1000,
+                            verbose=False, ax=None, epsilon=0.01,
+                            method='iterative', trace=None, callback=None):
+    """ Perform modified policy iteration, i.e. policy iteration in which each
+    policy is only evaluated with k sweeps, starting from the values of the
+    previous policy.
+
+    Args:
+        mdp - a MarkovDecisionProcess
+        k - the number of evaluation sweeps per improvement. If None, each
+            policy is evaluated until convergence, which is policy iteration.
+        policy - an (optional) initial policy, a numpy array, size |S| X |A|
+        n_iterations - the maximum number of policy improvements
+        verbose - whether to print intermediate results
+        ax - if this is a matplotlib axes, you can plot on it
+        epsilon - stop when the policy is stable and no value changed more
+            than this during the last evaluation sweep
+        method - how to evaluate the policies if k is None, see
+            policyEvaluation()
+        trace - (optional) a SolverTrace, see policyEvaluation(). Each
+            evaluation and improvement is recorded as one iteration, whose
+            residual is the largest change of a value.
+        callback - (optional) a function callback(iteration, V, residual),
+            called after each improvement. The solver stops if it returns
+            True.
+
+    Returns a tuple with:
+        the (optimal) values, a numpy array of size len(S)
+        the (optimal) policy, a deterministic numpy array of size
+        len(S) X len(A)
+
+    """
+    n_states = len(mdp.S)
+    n_actions = len(mdp.A)
+
+    # If no policy is passed, initialize a random one.
+    if policy is None:
+        policy = _uniformPolicy(mdp)
+
+    if k is None:
+        n_sweeps = 1000
+    else:
+        n_sweeps = k
+        method = 'iterative'
+
+    trace = _startTrace(trace, callback)
+    evaluation_trace = SolverTrace()
+    rewards = mdp.expectedRewards()
+    V = np.zeros((n_states,), dtype=mdp.dtype)
+    actions = None
+    for i_iteration in range(n_iterations):
+        V_previous = V.copy()
+        evaluation_trace.start()
+        (V, residual) = _evaluatePolicy(mdp, policy, rewards, V, n_sweeps,
+                                        epsilon, method, 'jacobi', 64,
+                                        evaluation_trace)
+
+        new_actions = _greedyActions(_actionValues(mdp, V, rewards), actions)
+        is_stable = actions is not None and np.all(new_actions == actions)
+        actions = new_actions
+        policy = _deterministicPolicy(actions, n_actions, mdp.dtype)
+
+        if verbose:
+            print('Improvement ' + str(i_iteration + 1) + '\n' +
+                  mdp.policyStringMode(policy) + '\n')
+
+        n_backups = sum(evaluation_trace.n_backups) + n_states
+        if trace.record(V, np.max(np.abs(V - V_previous)), n_backups):
+            break
+        if is_stable and residual < _tolerance(V, epsilon):
+            break
+
+    if verbose:
+        print('Policy iteration: ' + str(trace) + '\n')
+
+    if ax:
+        mdp.plotValues(ax, V, policy)
 
-    # Return (optimal?) values and (optimal?) policy
     return (V, policy)
 
 
@@ -183,5 +1163,16 @@ if __name__ == '__main__':
     if ax2:
         mdp.plotValues(ax2, values, policy)
 
+    # VALUE ITERATION DONE: DO POLICY ITERATION
+
+    # Perform policy iteration
+    print("________________________________________________________")
+    print("Performing policy iteration.")
+    (values, policy) = policyIteration(mdp, None, 100, verbose)
+
+    # Print the result
+    print("ARGMAX POLICY\n" + mdp.policyStringMode(policy) + '\n')
+    print("VALUES\n" + mdp.valuesString(values) + '\n')
+
     if ax1 and ax2:
         plt.show()
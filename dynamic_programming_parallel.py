@@ -0,0 +1,177 @@
+""" Multi-core Bellman sweeps, with the MDP in shared memory.
+
+The transition matrix, the expected rewards and the values are copied once
+into multiprocessing.shared_memory blocks. The worker processes attach to
+them when they start, and each backs up its own block of states in place, so
+that only block indices go through the pipes of the process pool.
+
+Each sweep still costs a round trip through the pool, and the workers
+compete for memory bandwidth, so the speedup depends on the machine. It
+needs at least as many free cores as workers: on a single core, 1 to 4
+workers are slower than the serial sweeps (0.75x to 0.93x on a 300 X 300
+grid). Measure it with benchmark_dynamic_programming.py before relying on
+it.
+"""
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+import scipy.sparse
+
+from dynamic_programming import _tolerance
+
+# The shared arrays, as seen by a worker process. See _attachShared().
+_shared = {}
+
+
+def _createShared(array, segments):
+    """ Copy an array into a new shared memory block.
+
+    Args:
+        array - a numpy array
+        segments - a list, to which the new SharedMemory is appended
+
+    Returns a tuple with:
+        the shared copy of the array
+        a tuple (name, shape, dtype) from which _attachShared() can rebuild
+        the array in another process
+    """
+    segment = shared_memory.SharedMemory(create=True,
+                                         size=max(1, array.nbytes))
+    segments.append(segment)
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)
+    shared[...] = array
+    return (shared, (segment.name, array.shape, array.dtype.str))
+
+
+def _attachShared(specs, n_actions, discount):
+    """ Initialize a worker process: map the shared arrays into it.
+
+    Args:
+        specs - a dictionary from array names to what _createShared()
+            returned for them
+        n_actions - number of actions of the MDP
+        discount - discount factor of the MDP
+    """
+    _shared.clear()
+    segments = []
+    for key, (name, shape, dtype) in specs.items():
+        segment = shared_memory.SharedMemory(name=name)
+        segments.append(segment)
+        _shared[key] = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+    # The arrays are only valid as long as their segments are open.
+    _shared['segments'] = segments
+    _shared['n_actions'] = n_actions
+    _shared['discount'] = discount
+
+
+def _transitionRows(start, stop):
+    """ Return rows start..stop of the shared transition matrix, without
+    copying its non-zeros.
+    """
+    if 'P' in _shared:
+        return _shared['P'][start:stop]
+
+    indptr = _shared['P_indptr']
+    (first, last) = (indptr[start], indptr[stop])
+    return scipy.sparse.csr_matrix(
+        (_shared['P_data'][first:last], _shared['P_indices'][first:last],
+         indptr[start:stop + 1] - first),
+        shape=(stop - start, _shared['V'].shape[1]), copy=False)
+
+
+def _backupBlock(task):
+    """ Back up one block of states, reading the values from one buffer and
+    writing them to the other one. This runs in a worker process.
+
+    Args:
+        task - a tuple (i_block, start, stop, source): the block number, its
+            states start..stop, and the index of the buffer with the values
+            of the previous sweep
+    """
+    (i_block, start, stop, source) = task
+    n_actions = _shared['n_actions']
+    V_old = _shared['V'][source]
+    V_new = _shared['V'][1 - source]
+
+    P = _transitionRows(start * n_actions, stop * n_actions)
+    Q = _shared['rewards'][start:stop] + _shared['discount'] * \
+        P.dot(V_old).reshape(stop - start, n_actions)
+    V_new[start:stop] = np.max(Q, axis=1)
+
+    _shared['residuals'][i_block] = \
+        np.max(np.abs(V_new[start:stop] - V_old[start:stop]))
+
+
+def parallelSweeps(mdp, V, rewards, n_iterations, epsilon, n_workers,
+                   trace=None):
+    """ Repeat Jacobi sweeps of value iteration on several processes, until
+    the residual drops below epsilon.
+
+    The states are split into one contiguous block per worker. The workers
+    synchronize once per sweep, when the buffers with the previous and the
+    new values are swapped. The transitions of an implicit MDP are
+    materialized as a sparse matrix first, so that they can be shared.
+
+    Args:
+        mdp - a MarkovDecisionProcess
+        V - the initial values, a numpy array of size len(S)
+        rewards - the expected rewards, a numpy array of size len(S) X len(A)
+        n_iterations - the maximum number of sweeps
+        epsilon - stop when no value changes more than this during a sweep
+        n_workers - the number of worker processes
+        trace - (optional) a dynamic_programming.SolverTrace, in which each
+            sweep is recorded
+
+    Returns a tuple with:
+        the values, a numpy array of size len(S)
+        the residual of the last sweep
+    """
+    n_states = len(mdp.S)
+    n_workers = max(1, min(n_workers, n_states))
+    bounds = np.linspace(0, n_states, n_workers + 1).astype(int)
+
+    segments = []
+    arrays = {}
+    specs = {}
+    try:
+        P = mdp.transitionMatrix()
+        if scipy.sparse.issparse(P):
+            shared = {'P_data': P.data, 'P_indices': P.indices,
+                      'P_indptr': P.indptr}
+        else:
+            shared = {'P': np.ascontiguousarray(P)}
+        shared['rewards'] = rewards
+        shared['V'] = np.array([V, V], dtype=mdp.dtype)
+        shared['residuals'] = np.zeros(n_workers)
+        for key, array in shared.items():
+            (arrays[key], specs[key]) = _createShared(array, segments)
+
+        pool = multiprocessing.Pool(n_workers, _attachShared,
+                                    (specs, len(mdp.A), mdp.discount))
+        try:
+            source = 0
+            residual = np.inf
+            for _ in range(n_iterations):
+                tasks = [(i, bounds[i], bounds[i + 1], source)
+                         for i in range(n_workers)]
+                pool.map(_backupBlock, tasks)
+                source = 1 - source
+                residual = np.max(arrays['residuals'])
+                if trace is not None and \
+                        trace.record(arrays['V'][source], residual, n_states):
+                    break
+                if residual < _tolerance(arrays['V'][source], epsilon):
+                    break
+            V = arrays['V'][source].copy()
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        # The views must be released before their segments can be closed.
+        arrays.clear()
+        for segment in segments:
+            segment.close()
+            segment.unlink()
+
+    return (V, residual)
@@ -0,0 +1,391 @@
+""" Value iteration on an MDPGrid, with the values kept as a 2D array.
+
+Every action of a grid moves an agent to the same neighbouring cell, wherever
+it is, unless that cell is a wall or outside the grid. So the expected value
+of the next state of an action is a shifted copy of the values, mixed with
+the values themselves by a per-cell mask. A sweep is then a few whole-array
+operations per action, and needs O(len(S)) memory instead of P.
+"""
+import numpy as np
+
+from dynamic_programming import _tolerance
+from mdps.mdp_grid import MDPGrid
+
+# Shift of the row and column of each action of MDPGrid
+_MOVES = {'LEFT': (0, -1), 'RIGHT': (0, 1), 'UP': (-1, 0), 'DOWN': (1, 0)}
+
+
+def _shifted(values, d_row, d_col, out):
+    """ Write the value of the neighbour (i+d_row, j+d_col) of each cell
+    (i, j) to out. Cells without such a neighbour get their own value.
+    """
+    out[...] = values
+    (n_rows, n_cols) = values.shape
+    out[max(0, -d_row):n_rows - max(0, d_row),
+        max(0, -d_col):n_cols - max(0, d_col)] = \
+        values[max(0, d_row):n_rows - max(0, -d_row),
+               max(0, d_col):n_cols - max(0, -d_col)]
+    return out
+
+
+def _discountedSteps(discount, n_steps):
+    """ Return sum_{k < n_steps} discount^k."""
+    if discount == 1.0:
+        return float(n_steps)
+    return (1.0 - discount ** n_steps) / (1.0 - discount)
+
+
+class GridStencil:
+
+    """ The Bellman backups of an MDPGrid, as operations on 2D arrays.
+
+    The stencil is built from the parameters of the grid (its size, walls,
+    terminal cells, stochasticity and bump penalty), not from P, so it also
+    works for implicit grids. Values are numpy arrays of size
+    n_rows X n_cols, in the dtype of the grid.
+    """
+
+    def __init__(self, mdp, n_steps=1):
+        """ Build the stencil of a grid.
+
+        Args:
+            mdp - an MDPGrid
+            n_steps - the number of moves that a move of this grid stands
+                for. It is more than 1 for the coarse grids of
+                multigridValueIteration(): the discount factor and the rewards
+                of a move are then those of n_steps moves in a row.
+        """
+        if not isinstance(mdp, MDPGrid):
+            raise ValueError('A stencil needs an MDPGrid, not a ' +
+                             type(mdp).__name__)
+        shape = (mdp.n_rows, mdp.n_cols)
+        self.shape = shape
+        self.dtype = mdp.dtype
+        self.discount = mdp.discount ** n_steps
+        # A number, or one per cell
+        stochasticity = np.reshape(
+            np.broadcast_to(mdp.stochasticity, (len(mdp.S),)), shape)
+
+        # The discounted sum of the rewards of n_steps moves, for a reward of
+        # 1 per move, and the reward of reaching a terminal state at the end
+        # of n_steps moves.
+        step_rewards = _discountedSteps(mdp.discount, n_steps)
+        terminal_reward = mdp.discount ** (n_steps - 1) * 100.0 - \
+            _discountedSteps(mdp.discount, n_steps - 1)
+
+        # Terminal states and walls keep a value of 0
+        can_act = np.asarray(mdp._can_act).reshape(shape)
+        self._discounts = (self.discount * can_act).astype(self.dtype)
+
+        # For each action, the probability of reaching the neighbour, and
+        # the expected reward. See MDPGrid._gridSuccessors().
+        states = np.arange(len(mdp.S))
+        is_terminal = np.asarray(mdp._is_terminal)
+        # The cell that each action moves to, or the cell itself for a bump
+        self._targets = np.asarray(mdp._targets)
+        self._moves = []
+        for (action, name) in enumerate(mdp.A):
+            targets = self._targets[:, action]
+            moved = (targets != states).reshape(shape)
+            move_rewards = np.where(is_terminal[targets], terminal_reward,
+                                    -step_rewards).reshape(shape)
+            rewards = np.where(
+                moved,
+                (1.0 - stochasticity) * move_rewards -
+                stochasticity * step_rewards,
+                ((1.0 - stochasticity) * mdp.bump_penalty - stochasticity) *
+                step_rewards)
+            self._moves.append((_MOVES[name],
+                                ((1.0 - stochasticity) * moved).astype(
+                                    self.dtype),
+                                (rewards * can_act).astype(self.dtype)))
+
+    def actionValue(self, V, action, buffer=None):
+        """ Compute the values Q(s,a) of one action in all cells.
+
+        Args:
+            V - the values, a numpy array of size n_rows X n_cols
+            action - the index of the action
+            buffer - (optional) a numpy array of the same size, used for the
+                shifted values
+
+        Returns:
+            the action values, a numpy array of size n_rows X n_cols
+        """
+        ((d_row, d_col), p_move, rewards) = self._moves[action]
+        if buffer is None:
+            buffer = np.empty_like(V)
+        shifted = _shifted(V, d_row, d_col, buffer)
+        # E(s,a) = V(s) + p_move(s,a) * (V(s') - V(s))
+        shifted -= V
+        shifted *= p_move
+        shifted += V
+        shifted *= self._discounts
+        shifted += rewards
+        return shifted
+
+    def actionValues(self, V):
+        """ Compute the values Q(s,a) of all actions in all cells.
+
+        Args:
+            V - the values, a numpy array of size n_rows X n_cols
+
+        Returns:
+            the action values, a numpy array of size len(S) X len(A), as
+            returned by the other solvers
+        """
+        return np.stack([self.actionValue(V, action).ravel()
+                         for action in range(len(self._moves))], axis=1)
+
+    def greedy(self, V):
+        """ Back up all the states once, like sweep(), and find the greedy
+        actions.
+
+        Returns a tuple with:
+            the new values, a numpy array of size n_rows X n_cols
+            the greedy action of each cell, a numpy array of ints of the same
+            size
+        """
+        Q = np.stack([self.actionValue(V, action)
+                      for action in range(len(self._moves))])
+        return (np.max(Q, axis=0), np.argmax(Q, axis=0))
+
+    def policyCorrection(self, actions, residuals):
+        """ Solve the policy evaluation equation of a correction exactly:
+        e = residuals + discount * P_pi e, where P_pi are the transitions of
+        the policy 'actions'.
+
+        Under a fixed policy, an agent either stays in its cell or moves to
+        one neighbour, t(s). So e(s) = c(s) + f(s) e(t(s)), and substituting
+        e(t(s)) in turn doubles the length of the paths that c and f cover.
+        After log2(the longest path) such rounds, all the paths end in a
+        cell that does not move: a terminal state, a wall or a bump.
+
+        Args:
+            actions - the action of each cell, a numpy array of ints of size
+                n_rows X n_cols
+            residuals - the right-hand side, a numpy array of the same size
+
+        Returns a tuple with:
+            the correction e, a numpy array of size n_rows X n_cols, or None
+            if the policy never ends in some cells, e.g. it bumps forever
+            without discount
+            the number of rounds
+        """
+        actions = actions.ravel()
+        discounts = self._discounts.ravel()
+        p_move = np.choose(actions, [p_move.ravel()
+                                     for (_, p_move, _) in self._moves])
+        targets = np.choose(actions, list(self._targets.T))
+
+        # e(s) (1 - discount (1 - p_move)) = residual + discount p_move e(t)
+        diagonal = 1.0 - discounts * (1.0 - p_move)
+        if np.any(diagonal <= 0.0):
+            return (None, 0)
+        factors = discounts * p_move / diagonal
+        corrections = residuals.ravel() / diagonal
+
+        for n_rounds in range(64):
+            if not np.any(factors):
+                return (corrections.reshape(self.shape), n_rounds)
+            corrections += factors * corrections[targets]
+            factors *= factors[targets]
+            targets = targets[targets]
+        # A cycle of moves without discount
+        return (None, n_rounds)
+
+    def sweep(self, V, buffer=None):
+        """ Back up all the states once, from the values of the previous
+        sweep.
+
+        Returns a tuple with:
+            the new values, a numpy array of size n_rows X n_cols
+            the residual, i.e. the largest absolute change of a value
+        """
+        if buffer is None:
+            buffer = np.empty_like(V)
+        V_new = self.actionValue(V, 0)
+        for action in range(1, len(self._moves)):
+            np.maximum(V_new, self.actionValue(V, action, buffer), out=V_new)
+        return (V_new, np.max(np.abs(V_new - V)))
+
+    def iterate(self, V, n_iterations, epsilon, trace=None):
+        """ Repeat sweeps until the residual drops below epsilon.
+
+        Args:
+            V - the initial values, a numpy array of size len(S)
+            n_iterations - the maximum number of sweeps
+            epsilon - stop when no value changes more than this during a
+                sweep
+            trace - (optional) a dynamic_programming.SolverTrace, in which
+                each sweep is recorded
+
+        Returns a tuple with:
+            the values, a numpy array of size len(S)
+            the residual of the last sweep
+        """
+        V = np.array(V, dtype=self.dtype).reshape(self.shape)
+        buffer = np.empty_like(V)
+        n_states = V.size
+        residual = np.inf
+        for _ in range(n_iterations):
+            (V, residual) = self.sweep(V, buffer)
+            if trace is not None and \
+                    trace.record(V.ravel(), residual, n_states):
+                break
+            if residual < _tolerance(V, epsilon):
+                break
+        return (V.ravel(), residual)
+
+    def correctedIterate(self, V, n_iterations, epsilon, trace=None,
+                         n_presweeps=8):
+        """ Repeat sweeps until the residual drops below epsilon, with
+        Newton corrections from policyCorrection() in between.
+
+        A correction makes the values those of the greedy policy, as in
+        policy iteration, which reaches the far side of the grid at once.
+        The first one comes after n_presweeps sweeps, which settle the
+        values around the terminal states, where a warm start from a coarse
+        grid is the least accurate. From the first correction on, the values
+        are a lower bound of the optimal ones, which only grows: each
+        correction keeps the larger of the policy values and of a sweep.
+        Where the greedy policies keep changing, e.g. in mazes of thin
+        walls, corrections do not pay off: while a correction does not halve
+        the residual, the number of sweeps until the next one doubles, so
+        that they cost little more than sweeps alone.
+
+        Args and returned values: see iterate(). An iteration is a sweep,
+        with a correction after it or not.
+        """
+        V = np.array(V, dtype=self.dtype).reshape(self.shape)
+        buffer = np.empty_like(V)
+        n_states = V.size
+        residual = np.inf
+        is_lower_bound = False
+        next_correction = n_presweeps
+        n_between = 0  # Sweeps between two corrections
+        corrected_residual = None
+        for iteration in range(n_iterations):
+            if iteration < next_correction:
+                (V_new, residual) = self.sweep(V, buffer)
+            else:
+                (V_new, actions) = self.greedy(V)
+                residual = np.max(np.abs(V_new - V))
+            n_backups = n_states
+            if residual < _tolerance(V_new, epsilon):
+                V = V_new
+                if trace is not None:
+                    trace.record(V.ravel(), residual, n_backups)
+                break
+
+            if iteration < next_correction:
+                V = V_new
+            else:
+                (corrections, n_rounds) = self.policyCorrection(actions,
+                                                                V_new - V)
+                n_backups += n_rounds * n_states
+                if corrections is None:
+                    V = V_new
+                elif is_lower_bound:
+                    V = np.maximum(V + corrections, V_new)
+                else:
+                    V = V + corrections
+                    is_lower_bound = True
+                if corrections is None or (
+                        corrected_residual is not None and
+                        residual > 0.5 * corrected_residual):
+                    n_between = max(1, 2 * n_between)
+                corrected_residual = residual
+                next_correction = iteration + 1 + n_between
+
+            if trace is not None and \
+                    trace.record(V.ravel(), residual, n_backups):
+                break
+        return (V.ravel(), residual)
+
+
+def coarsenGrid(mdp):
+    """ Build a grid with half the number of rows and columns.
+
+    Each cell of the coarse grid covers 2 X 2 cells of the fine one. It is a
+    wall if all of them are walls, and terminal if one of them is terminal.
+    A per-cell stochasticity is averaged over the cells that are not walls.
+
+    Args:
+        mdp - an MDPGrid
+    Returns:
+        an implicit MDPGrid, with the same stochasticity, discount, bump
+        penalty and dtype
+    """
+    (n_rows, n_cols) = ((mdp.n_rows + 1) // 2, (mdp.n_cols + 1) // 2)
+
+    # Cells past the edge of the fine grid count as walls
+    is_wall = np.ones((2 * n_rows, 2 * n_cols), dtype=bool)
+    is_wall[:mdp.n_rows, :mdp.n_cols] = \
+        np.asarray(mdp.is_wall).reshape(mdp.n_rows, mdp.n_cols)
+    is_wall = is_wall.reshape(n_rows, 2, n_cols, 2).all(axis=(1, 3)).ravel()
+
+    (rows, cols) = np.divmod(np.flatnonzero(mdp._is_terminal), mdp.n_cols)
+    terminals = np.unique((rows // 2) * n_cols + cols // 2)
+    is_wall[terminals] = False
+
+    # A per-cell stochasticity is averaged over the fine cells of each
+    # coarse cell that are not walls
+    stochasticity = mdp.stochasticity
+    if np.ndim(stochasticity) > 0:
+        weights = np.zeros((2 * n_rows, 2 * n_cols))
+        weights[:mdp.n_rows, :mdp.n_cols] = \
+            ~np.asarray(mdp.is_wall).reshape(mdp.n_rows, mdp.n_cols)
+        total = np.zeros_like(weights)
+        total[:mdp.n_rows, :mdp.n_cols] = \
+            np.reshape(stochasticity, (mdp.n_rows, mdp.n_cols))
+        total = (total * weights).reshape(n_rows, 2, n_cols, 2).sum(
+            axis=(1, 3))
+        weights = weights.reshape(n_rows, 2, n_cols, 2).sum(axis=(1, 3))
+        stochasticity = (total / np.maximum(weights, 1.0)).ravel()
+
+    return MDPGrid(n_rows, n_cols, stochasticity, mdp.discount,
+                   terminals=terminals, is_wall=is_wall, implicit=True,
+                   bump_penalty=mdp.bump_penalty, dtype=mdp.dtype)
+
+
+def _interpolateAxis(values, axis):
+    """ Linearly interpolate values to twice as many cells along one axis.
+
+    The fine cells 2k and 2k+1 are at 1/4 and 3/4 of coarse cell k, so they
+    get 3/4 of its value and 1/4 of the value of its neighbour on their side.
+    The cells at the ends take their missing neighbour to be 0.
+    """
+    values = np.moveaxis(values, axis, 0)
+    padded = np.concatenate([np.zeros_like(values[:1]), values,
+                             np.zeros_like(values[:1])])
+    fine = np.empty((2 * len(values),) + values.shape[1:], dtype=values.dtype)
+    fine[0::2] = 0.75 * values + 0.25 * padded[:-2]
+    fine[1::2] = 0.75 * values + 0.25 * padded[2:]
+    return np.moveaxis(fine, 0, axis)
+
+
+def upsample(values, coarse_mdp, mdp):
+    """ Interpolate the values of a coarse grid to the fine grid it was
+    built from with coarsenGrid().
+
+    The values are interpolated bilinearly between the centers of the
+    coarse cells, from the coarse cells that are neither walls nor
+    terminal: those have a value of 0, which says nothing about the values
+    of the cells around them. A fine cell without any such coarse cell
+    around it gets the value of the coarse cell that covers it.
+
+    Returns:
+        the values of the fine grid, a numpy array of size len(S)
+    """
+    shape = (coarse_mdp.n_rows, coarse_mdp.n_cols)
+    values = np.asarray(values).reshape(shape)
+    weights = np.asarray(coarse_mdp._can_act, dtype=values.dtype).reshape(
+        shape)
+
+    total = _interpolateAxis(_interpolateAxis(values * weights, 0), 1)
+    weights = _interpolateAxis(_interpolateAxis(weights, 0), 1)
+    covering = values.repeat(2, axis=0).repeat(2, axis=1)
+    fine = np.where(weights > 0, total / np.maximum(weights, 1e-12),
+                    covering)
+    return fine[:mdp.n_rows, :mdp.n_cols].ravel()
@@ -1,14 +1,53 @@
-import numpy as np
 import random
 
+import numpy as np
+
 from .environment import Environment
 
 
+# The maze of EnvMaze when no char_grid is given
+DEFAULT_CHAR_GRID = [
+    ['T', '.', '.', '.', '.'],
+    ['.', '.', '.', '.', '.'],
+    ['.', '.', '.', '.', '.'],
+    ['W', 'W', '.', 'W', 'W'],
+    ['.', '.', '.', '.', '.'],
+    ['.', '.', '.', '.', '.'],
+]
+
+
+def mazeCells(char_grid):
+    """ Classify the cells of a maze.
+
+    Arguments:
+        char_grid - a list of lists of characters, see EnvMaze
+
+    Returns a tuple with three numpy arrays of booleans, with one element per
+    cell in row-major order (the observations of EnvMaze):
+        is_wall - the cells that are walls ('W')
+        is_terminal - the cells that are terminal ('T')
+        is_free - the cells in which an episode can start ('.' or ' ')
+    """
+    cells = np.array([list(row) for row in char_grid]).ravel()
+    return (cells == 'W', cells == 'T', (cells == '.') | (cells == ' '))
+
+
 class EnvMaze(Environment):
 
-    """ Environment for represting mazes (grids with walls). """
+    """ Environment for represting mazes (grids with walls).
 
-    def __init__(self, char_grid=None, stochasticity=0.0, bump_penalty=0):
+    The maze is compiled at construction into lookup tables indexed by the
+    observations, the states s = row * n_cols + col:
+        next_state[s, a] - the state reached by action a from s, if it does
+            not slip
+        bumped[s, a] - whether action a from s bumps into a wall or the edge
+        is_terminal[s] - whether s is a terminal cell
+    The position of the agent is a single state, so that a step is a couple
+    of table lookups and one random draw.
+    """
+
+    def __init__(self, char_grid=None, stochasticity=0.0, bump_penalty=0,
+                 seed=None):
         """ Initialize a maze environment.
 
         Arguments:
@@ -18,17 +57,13 @@ class EnvMaze(Environment):
             stochasticity - probability that an action does not have any effect
 
             bump_penalty - penalty for bumping in to a wall, e.g. -10
+
+            seed - (optional) the seed of the maze's random generator, see
+            seed(). By default, it is seeded from the operating system.
         """
         if not char_grid:
             # Initialize with default grid
-            char_grid = [
-                ['T', '.', '.', '.', '.'],
-                ['.', '.', '.', '.', '.'],
-                ['.', '.', '.', '.', '.'],
-                ['W', 'W', '.', 'W', 'W'],
-                ['.', '.', '.', '.', '.'],
-                ['.', '.', '.', '.', '.'],
-            ]
+            char_grid = DEFAULT_CHAR_GRID
 
         self._char_grid = char_grid
         self._n_rows = len(char_grid)
@@ -37,9 +72,10 @@ class EnvMaze(Environment):
         # Action space
         self.A = ['LEFT', 'RIGHT', 'UP', 'DOWN']
 
-        # Current position of the robot
-        self._agent_row = 0
-        self._agent_col = 0
+        self._compile()
+
+        # Current position of the robot, as a state
+        self._state = 0
 
         # Did the agent bump into a wall when going from the previous state to
         # the current one?
@@ -50,6 +86,38 @@ class EnvMaze(Environment):
 
         self._stochasticity = stochasticity
 
+        self.seed(seed)
+
+    def _compile(self):
+        """ Build the lookup tables of the maze, see the class documentation.
+        """
+        (is_wall, is_terminal, is_free) = mazeCells(self._char_grid)
+        (rows, cols) = np.divmod(np.arange(self.numStates()), self._n_cols)
+        # Move of each action: LEFT, RIGHT, UP, DOWN
+        d_rows = np.array([0, 0, -1, 1])
+        d_cols = np.array([-1, 1, 0, 0])
+
+        new_rows = rows[:, None] + d_rows
+        new_cols = cols[:, None] + d_cols
+        is_inside = (new_rows >= 0) & (new_rows < self._n_rows) & \
+            (new_cols >= 0) & (new_cols < self._n_cols)
+        targets = np.where(is_inside, new_rows * self._n_cols + new_cols, 0)
+        bumped = ~is_inside | is_wall[targets]
+
+        states = np.arange(self.numStates())
+        self.next_state = np.where(bumped, states[:, None], targets)
+        self.bumped = bumped
+        self.is_terminal = is_terminal
+
+        # Indexing lists is several times faster than indexing numpy arrays
+        # with scalars, so the steps use list copies of the tables.
+        self._next_states = self.next_state.tolist()
+        self._bumps = bumped.tolist()
+        self._terminals = is_terminal.tolist()
+        self._starts = is_free.tolist()
+        self._action_indices = dict((name, a) for (a, name) in
+                                    enumerate(self.A))
+
     def numActions(self):
         """ See documentation in base class."""
         return len(self.A)
@@ -60,7 +128,7 @@ class EnvMaze(Environment):
 
     def isFinished(self):
         """ See documentation in base class."""
-        return self._char_grid[self._agent_row][self._agent_col] == 'T'
+        return self._terminals[self._state]
 
     # def isTerminalState(self, state):
     #    """ See documentation in base class."""
@@ -72,60 +140,52 @@ class EnvMaze(Environment):
         """ See documentation in base class."""
         valid_agent_position = False
         while not valid_agent_position:
-            row = random.randint(0, self._n_rows - 1)
-            col = random.randint(0, self._n_cols - 1)
-            char = self._char_grid[row][col]
-            if char == '.' or char == ' ':
-                self._agent_row = row
-                self._agent_col = col
+            row = self._random.randint(0, self._n_rows - 1)
+            col = self._random.randint(0, self._n_cols - 1)
+            state = row * self._n_cols + col
+            if self._starts[state]:
+                self._state = state
                 valid_agent_position = True
 
     def performAction(self, action):
         """ See documentation in base class."""
 
-        if random.random() < self._stochasticity:
-            # State doesn't change
+        if self._random.random() < self._stochasticity:
+            # State doesn't change, and the agent did not bump
             self.last_reward = -1
+            self._prev_bumped = False
             return
 
-        new_agent_row = self._agent_row
-        new_agent_col = self._agent_col
-
-        if isinstance(action, int):
-            action = self.A[action]
-
-        if action == 'LEFT':
-            new_agent_col -= 1
-        if action == 'RIGHT':
-            new_agent_col += 1
-        if action == 'UP':
-            new_agent_row -= 1
-        if action == 'DOWN':
-            new_agent_row += 1
-
-        bumped = False
-        if new_agent_row < 0 or new_agent_row >= self._n_rows:
-            bumped = True
-        elif new_agent_col < 0 or new_agent_col >= self._n_cols:
-            bumped = True
-        elif self._char_grid[new_agent_row][new_agent_col] == 'W':
-            bumped = True
-
-        if not bumped:
-            # Didn't bump into wall: move agent
-            self._agent_row = new_agent_row
-            self._agent_col = new_agent_col
+        if isinstance(action, str):
+            action = self._action_indices[action]
+
+        bumped = self._bumps[self._state][action]
+        self._state = self._next_states[self._state][action]
 
         # getReward needs to know if the agent bumped. So store it here.
         self._prev_bumped = bumped
 
+    def seed(self, seed=None):
+        """ See documentation in base class."""
+        self._random = random.Random(seed)
+
+    def getState(self):
+        """ See documentation in base class."""
+        return (self._state, self._prev_bumped, self._random.getstate())
+
+    def setState(self, state, restore_random=True):
+        """ See documentation in base class."""
+        (self._state, self._prev_bumped, random_state) = state
+        if restore_random:
+            self._random.setstate(random_state)
+
     def getReward(self):
         """ Compute and return the current reward
         (i.e. corresponding to the last action performed)
         """
 
         # Found the exit! (all terminal states are exits)
-        if self._char_grid[self._agent_row][self._agent_col] == 'T':
+        if self._terminals[self._state]:
             return 100.0
 
         # Bumped into a wall
@@ -137,7 +197,7 @@ class EnvMaze(Environment):
 
     def getObservation(self):
         """ See documentation in base class."""
-        return self._agent_row * self._n_cols + self._agent_col
+        return self._state
 
     def __str__(self):
         return self.stateString()
@@ -145,15 +205,48 @@ class EnvMaze(Environment):
     def stateString(self):
         """ See documentation in base class."""
         string = ''
+        (agent_row, agent_col) = divmod(self._state, self._n_cols)
         for ii in range(self._n_rows):
             for jj in range(self._n_cols):
-                if self._agent_row == ii and self._agent_col == jj:
+                if agent_row == ii and agent_col == jj:
                     string += 'A '
                 else:
                     string += self._char_grid[ii][jj] + ' '
             string += '\n'
         return string
 
+    def toMDP(self, discount=1.0, sparse=True, dtype=np.float64):
+        """ Compile the maze into an equivalent Markov Decision Process.
+
+        Its states are the observations of the environment, and its
+        transition probabilities and expected rewards are those of
+        performAction() and getReward(), so that it can be solved with
+        dynamic_programming to get the exact optimal returns.
+
+        Arguments:
+            discount - discount factor of the MDP
+            sparse - whether to store the MDP sparsely, see MDPGrid
+            dtype - floating point type of the MDP, see MDPGrid
+
+        Returns:
+            an MDPGrid
+        """
+        from mdps.mdp_grid import MDPGrid
+
+        if self._n_rows == 1:
+            # MDPGrid has no UP and DOWN actions for a single row
+            raise ValueError('Cannot compile a maze with a single row')
+
+        (is_wall, is_terminal, is_free) = mazeCells(self._char_grid)
+        mdp = MDPGrid(self._n_rows, self._n_cols, self._stochasticity,
+                      discount, sparse, terminals=np.flatnonzero(is_terminal),
+                      is_wall=is_wall, bump_penalty=float(self._bump_penalty),
+                      dtype=dtype)
+        mdp.name = 'Maze'
+        # reset() only starts in free cells
+        mdp.I = (is_free / float(np.sum(is_free))).tolist()
+        return mdp
+
     def actionString(self, action):
         """ See documentation in base class."""
         return str(self.A[action])
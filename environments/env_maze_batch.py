@@ -0,0 +1,137 @@
+import numpy as np
+
+from .env_maze import DEFAULT_CHAR_GRID, mazeCells
+
+# Codes of the cells of the compiled grid
+FREE = 0
+WALL = 1
+TERMINAL = 2
+
+
+class EnvMazeBatch:
+
+    """ N copies of EnvMaze, stepped at once with numpy.
+
+    The maze is compiled to a uint8 grid with a border of walls, so that
+    moving out of the maze is a bump like moving into a wall. The position of
+    each copy is a flat index into that grid, and a step applies the moves,
+    the stochastic no-ops, the bumps, the rewards and the resets of all the
+    copies with a few whole-array operations.
+
+    Each copy has the dynamics of EnvMaze: an action has no effect with
+    probability stochasticity, a bump leaves the agent where it is with a
+    reward of bump_penalty, reaching a terminal cell gives 100 and any other
+    step -1. The observations are the same cell indices. A copy that reaches
+    a terminal cell is reset at once to a random free cell: step() then
+    returns the reward of the terminal cell, with done set, and the first
+    observation of the next episode.
+    """
+
+    def __init__(self, char_grid=None, stochasticity=0.0, bump_penalty=0,
+                 n_envs=1, seed=None):
+        """ Initialize the copies of a maze, and reset them.
+
+        Arguments:
+            char_grid - a list of lists of characters, see EnvMaze
+            stochasticity - probability that an action does not have any effect
+            bump_penalty - penalty for bumping in to a wall, e.g. -10
+            n_envs - the number N of copies
+            seed - (optional) the seed of the random generator, for
+                reproducible runs
+        """
+        if not char_grid:
+            char_grid = DEFAULT_CHAR_GRID
+        self._n_rows = len(char_grid)
+        self._n_cols = len(char_grid[0])
+        self.A = ['LEFT', 'RIGHT', 'UP', 'DOWN']
+        self.n_envs = n_envs
+        self._stochasticity = stochasticity
+        self._bump_penalty = float(bump_penalty)
+        self._rng = np.random.default_rng(seed)
+
+        # The grid, with a border of walls around it
+        (is_wall, is_terminal, is_free) = mazeCells(char_grid)
+        width = self._n_cols + 2
+        grid = np.full((self._n_rows + 2, width), WALL, dtype=np.uint8)
+        grid[1:-1, 1:-1] = np.where(
+            is_wall, WALL, np.where(is_terminal, TERMINAL, FREE)).reshape(
+                self._n_rows, self._n_cols)
+        self.grid = grid
+        self._cells = grid.ravel()
+
+        # Conversions between the cells of the grid and the observations
+        (rows, cols) = np.divmod(np.arange(self.numStates()), self._n_cols)
+        self._state_cells = ((rows + 1) * width + cols + 1).astype(np.int32)
+        self._cell_states = np.full(grid.size, -1, dtype=np.int32)
+        self._cell_states[self._state_cells] = np.arange(self.numStates())
+        self._start_cells = self._state_cells[is_free]
+        if len(self._start_cells) == 0:
+            raise ValueError('A maze needs at least one free cell')
+
+        # Offset of the cell of each action: LEFT, RIGHT, UP, DOWN
+        self._moves = np.array([-1, 1, -width, width], dtype=np.int32)
+
+        self._positions = np.empty(n_envs, dtype=np.int32)
+        self.reset()
+
+    def numActions(self):
+        """ Return the number of actions of each copy."""
+        return len(self.A)
+
+    def numStates(self):
+        """ Return the number of observations of each copy."""
+        return self._n_rows * self._n_cols
+
+    def reset(self, observations=None):
+        """ Start a new episode in all the copies.
+
+        Args:
+            observations - (optional) the cells to start from, a numpy array
+                of ints of size N. By default, each copy starts in a random
+                free cell, like EnvMaze.reset().
+
+        Returns:
+            the observations, a numpy array of ints of size N
+        """
+        if observations is None:
+            self._positions[:] = self._rng.choice(self._start_cells,
+                                                  self.n_envs)
+        else:
+            self._positions[:] = self._state_cells[observations]
+        return self.getObservations()
+
+    def step(self, actions):
+        """ Perform one action in each copy.
+
+        Args:
+            actions - the actions, a numpy array of ints of size N
+
+        Returns a tuple with:
+            the observations after the actions, a numpy array of ints of size
+            N. The copies that finished have been reset already.
+            the rewards, a numpy array of floats of size N
+            whether the episode of each copy finished, a numpy array of
+            booleans of size N
+        """
+        positions = self._positions
+        targets = positions + self._moves[actions]
+        is_slip = self._rng.random(self.n_envs, dtype=np.float32) < \
+            self._stochasticity
+        bumped = (self._cells[targets] == WALL) & ~is_slip
+        np.copyto(positions, targets, where=~(bumped | is_slip))
+
+        dones = self._cells[positions] == TERMINAL
+        rewards = np.where(dones, 100.0,
+                           np.where(bumped, self._bump_penalty, -1.0))
+
+        finished = np.flatnonzero(dones)
+        if len(finished):
+            positions[finished] = self._rng.choice(self._start_cells,
+                                                   len(finished))
+        return (self.getObservations(), rewards, dones)
+
+    def getObservations(self):
+        """ Return the observation of each copy, a numpy array of ints of
+        size N.
+        """
+        return self._cell_states[self._positions]
@@ -0,0 +1,293 @@
+""" Several copies of an environment, stepped in worker processes.
+
+Each worker process owns a contiguous block of copies. The actions, and the
+observations, rewards and done flags of all the copies, live in
+multiprocessing.shared_memory blocks, so that the pipes to the workers only
+carry short commands and acknowledgements, never the results.
+"""
+import multiprocessing
+import random
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# The shared arrays, with their dtypes
+_ARRAYS = {'actions': np.int64, 'observations': np.int64,
+           'rewards': np.float64, 'dones': np.bool_}
+
+
+def _attachArrays(names, n_envs):
+    """ Map the shared arrays into a process.
+
+    Returns a tuple with:
+        a dictionary from array names to numpy arrays of size n_envs
+        the SharedMemory segments, which must stay open while the arrays
+        are used
+    """
+    arrays = {}
+    segments = []
+    for key, dtype in _ARRAYS.items():
+        segment = shared_memory.SharedMemory(name=names[key])
+        segments.append(segment)
+        arrays[key] = np.ndarray((n_envs,), dtype=dtype, buffer=segment.buf)
+    return (arrays, segments)
+
+
+def _worker(pipe, env_factory, start, stop, names, n_envs, seed,
+            env_seeds):
+    """ Run the copies start..stop of the environment. This runs in a worker
+    process, until it receives the 'close' command.
+
+    Each copy is seeded with its own seed in env_seeds, if they are given,
+    see EnvSubprocessVector.__init__().
+
+    The commands are 'reset' and 'step'. The worker answers each of them
+    with ('ok', None) once the shared arrays hold the results, or with
+    ('error', traceback) if an environment raised an exception.
+    """
+    # Forked workers would otherwise share the random state of the parent
+    random.seed(seed)
+    np.random.seed(None if seed is None else seed % 2**32)
+
+    (arrays, segments) = _attachArrays(names, n_envs)
+    try:
+        try:
+            envs = [env_factory() for _ in range(start, stop)]
+            if env_seeds is not None:
+                for (env, env_seed) in zip(envs, env_seeds):
+                    try:
+                        env.seed(env_seed)
+                    except NotImplementedError:
+                        # It draws from the modules seeded above
+                        pass
+            pipe.send(('ok', (envs[0].numActions(), envs[0].numStates())))
+        except Exception:
+            pipe.send(('error', traceback.format_exc()))
+            return
+        while True:
+            command = pipe.recv()
+            if command == 'close':
+                break
+            try:
+                if command == 'reset':
+                    for (i, env) in enumerate(envs, start):
+                        env.reset()
+                        arrays['observations'][i] = env.getObservation()
+                        arrays['rewards'][i] = 0.0
+                        arrays['dones'][i] = False
+                elif command == 'step':
+                    for (i, env) in enumerate(envs, start):
+                        env.performAction(int(arrays['actions'][i]))
+                        arrays['rewards'][i] = env.getReward()
+                        done = env.isFinished()
+                        arrays['dones'][i] = done
+                        if done:
+                            env.reset()
+                        arrays['observations'][i] = env.getObservation()
+                pipe.send(('ok', None))
+            except Exception:
+                pipe.send(('error', traceback.format_exc()))
+    finally:
+        # The views must be released before their segments can be closed.
+        arrays.clear()
+        for segment in segments:
+            segment.close()
+
+
+class EnvSubprocessVector:
+
+    """ K copies of any Environment, run by worker processes.
+
+    The copies reset themselves when their episode finishes: step() then
+    returns the reward of the last action, with done set, and the first
+    observation of the next episode, like environments.env_maze_batch.
+
+    stepAsync() starts a step and returns at once, so that the learner can
+    work while the workers simulate. stepWait() then waits for the results.
+    Call close(), or use the vector environment in a 'with' statement, to
+    stop the workers.
+    """
+
+    def __init__(self, env_factory, n_envs, n_workers=None, seed=None):
+        """ Start the workers, and reset all the copies.
+
+        Args:
+            env_factory - a function without arguments that returns a new
+                Environment, e.g. an Environment subclass or a
+                functools.partial of one. It must be picklable if worker
+                processes are spawned rather than forked.
+            n_envs - the number K of copies
+            n_workers - the number of worker processes (default: the number
+                of CPUs, and at most K)
+            seed - (optional) the seed of all the copies. Each copy gets a
+                seed of its own, spawned from it with np.random.SeedSequence,
+                and passed to its Environment.seed(). Copies that do not
+                override seed() draw from the random and numpy.random
+                modules, which worker w seeds with seed + w. By default,
+                every generator is seeded from the operating system, so that
+                the copies do not all draw the same random numbers.
+        """
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        n_workers = max(1, min(n_workers, n_envs))
+        self.n_envs = n_envs
+        self._segments = []
+        self._arrays = {}
+        self._pipes = []
+        self._processes = []
+        self._waiting = False
+
+        try:
+            names = {}
+            for key, dtype in _ARRAYS.items():
+                size = n_envs * np.dtype(dtype).itemsize
+                segment = shared_memory.SharedMemory(create=True,
+                                                     size=max(1, size))
+                self._segments.append(segment)
+                self._arrays[key] = np.ndarray((n_envs,), dtype=dtype,
+                                               buffer=segment.buf)
+                names[key] = segment.name
+
+            bounds = np.linspace(0, n_envs, n_workers + 1).astype(int)
+            if seed is None:
+                env_seeds = None
+            else:
+                env_seeds = [int(child.generate_state(1)[0]) for child in
+                             np.random.SeedSequence(seed).spawn(n_envs)]
+            for w in range(n_workers):
+                (pipe, worker_pipe) = multiprocessing.Pipe()
+                process = multiprocessing.Process(
+                    target=_worker,
+                    args=(worker_pipe, env_factory, bounds[w], bounds[w + 1],
+                          names, n_envs, None if seed is None else seed + w,
+                          None if seed is None else
+                          env_seeds[bounds[w]:bounds[w + 1]]),
+                    daemon=True)
+                process.start()
+                worker_pipe.close()
+                self._pipes.append(pipe)
+                self._processes.append(process)
+
+            sizes = self._receive()
+            (self._n_actions, self._n_states) = sizes[0]
+            self.reset()
+        except Exception:
+            self.close()
+            raise
+
+    def _receive(self):
+        """ Wait for the answer of every worker to the last command.
+
+        Returns:
+            the data of the answers, a list with one element per worker
+
+        Raises:
+            RuntimeError if a worker failed
+        """
+        try:
+            answers = [pipe.recv() for pipe in self._pipes]
+        except EOFError:
+            raise RuntimeError('A worker process exited')
+        for (status, data) in answers:
+            if status == 'error':
+                raise RuntimeError('An environment failed in a worker:\n' +
+                                   data)
+        return [data for (_, data) in answers]
+
+    def _send(self, command):
+        """ Send a command to every worker."""
+        for pipe in self._pipes:
+            pipe.send(command)
+
+    def numActions(self):
+        """ Return the number of actions of each copy."""
+        return self._n_actions
+
+    def numStates(self):
+        """ Return the number of states of each copy."""
+        return self._n_states
+
+    def reset(self):
+        """ Start a new episode in all the copies.
+
+        Returns:
+            the observations, a numpy array of ints of size K
+        """
+        if self._waiting:
+            self.stepWait()
+        self._send('reset')
+        self._receive()
+        return self._arrays['observations'].copy()
+
+    def stepAsync(self, actions):
+        """ Start one action in each copy, without waiting for the results.
+
+        Args:
+            actions - the actions, a numpy array of ints of size K
+        """
+        if self._waiting:
+            raise RuntimeError('stepWait() must be called before the next '
+                               'stepAsync()')
+        self._arrays['actions'][:] = actions
+        self._send('step')
+        self._waiting = True
+
+    def stepWait(self):
+        """ Wait for the step started by stepAsync().
+
+        Returns a tuple with:
+            the observations after the actions, a numpy array of ints of size
+            K. The copies that finished have been reset already.
+            the rewards, a numpy array of floats of size K
+            whether the episode of each copy finished, a numpy array of
+            booleans of size K
+        """
+        if not self._waiting:
+            raise RuntimeError('stepAsync() must be called before stepWait()')
+        self._waiting = False
+        self._receive()
+        # Copies, because the next step overwrites the shared arrays
+        return (self._arrays['observations'].copy(),
+                self._arrays['rewards'].copy(),
+                self._arrays['dones'].copy())
+
+    def step(self, actions):
+        """ Perform one action in each copy, and wait for the results.
+
+        See stepWait() for what is returned.
+        """
+        self.stepAsync(actions)
+        return self.stepWait()
+
+    def close(self):
+        """ Stop the workers, and free the shared memory."""
+        for (pipe, process) in zip(self._pipes, self._processes):
+            try:
+                if self._waiting:
+                    pipe.recv()
+                pipe.send('close')
+            except (OSError, EOFError):
+                pass
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        for pipe in self._pipes:
+            pipe.close()
+        self._pipes = []
+        self._processes = []
+        self._waiting = False
+
+        # The views must be released before their segments can be closed.
+        self._arrays.clear()
+        for segment in self._segments:
+            segment.close()
+            segment.unlink()
+        self._segments = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,23 +1,183 @@
 import numpy as np
-import random
 
 from .environment import Environment
- 
+
+
+def _rowCumsum(values, positions):
+    """ Compute cumulative sums that restart at the beginning of each row.
+
+    The sums are built by doubling the length of the partial sums, in
+    log2(the longest row) vectorized passes. Each sum then only adds up the
+    values of its own row, so its rounding error does not grow with the
+    number of rows, as it would in a running sum over all of them.
+
+    Args:
+        values - the values, a numpy array of floats, row after row
+        positions - the position of each value within its row, a numpy
+            array of ints
+    Returns:
+        the inclusive cumulative sums, a numpy array of floats
+    """
+    sums = np.array(values, dtype=np.float64)
+    step = 1
+    while step <= np.max(positions, initial=0):
+        has_previous = np.flatnonzero(positions >= step)
+        sums[has_previous] = sums[has_previous] + sums[has_previous - step]
+        step *= 2
+    return sums
+
+
+def _searchRows(keys, starts, stops, queries, side):
+    """ Find where queries would be inserted in sorted parts of an array,
+    like np.searchsorted() within keys[starts[i]:stops[i]] for query i.
+
+    All the queries are bisected together, in log2(the longest part)
+    vectorized passes.
+
+    Args:
+        keys - the keys, a numpy array sorted within each part
+        starts, stops - the bounds of the part of each query, numpy arrays
+            of ints
+        queries - the values to insert, a numpy array
+        side - 'left' or 'right', as in np.searchsorted()
+    Returns:
+        the insertion indices in keys, a numpy array of ints
+    """
+    (low, high) = (np.array(starts), np.array(stops))
+    while np.any(low < high):
+        middle = (low + high) // 2
+        is_searched = low < high
+        key = keys[np.minimum(middle, len(keys) - 1)]
+        if side == 'right':
+            is_below = key <= queries
+        else:
+            is_below = key < queries
+        low = np.where(is_searched & is_below, middle + 1, low)
+        high = np.where(is_searched & ~is_below, middle, high)
+    return low
+
+
+def aliasTables(indptr, probabilities):
+    """ Build Walker's alias tables for several discrete distributions, so
+    that each of them can be sampled in O(1).
+
+    Distribution r has the probabilities[indptr[r]:indptr[r+1]], as in a CSR
+    matrix. Each of its n outcomes k gets a cell, which is picked uniformly
+    with a threshold: the cell keeps k with probability threshold[k], and
+    gives alias[k] otherwise.
+
+    The tables are those of Vose's method, in which the 'small' outcomes
+    (probability below 1/n) fill up the 'large' ones in turn, and a large
+    outcome that drops below 1/n passes its own deficit to the next large
+    one. Which large outcome a small one falls into follows from the running
+    sums of the deficits and the excesses within the distribution, so all
+    the distributions are built at once, in
+    O(len(probabilities) log(len(probabilities))).
+
+    Args:
+        indptr - the bounds of the distributions, a numpy array of ints
+        probabilities - their probabilities, a numpy array of floats. Each
+            distribution is normalized, so its probabilities need not sum to
+            exactly 1, but they must not all be zero.
+    Returns a tuple with:
+        the thresholds, a numpy array of floats aligned with probabilities
+        the aliases, a numpy array of ints aligned with probabilities, with
+        outcomes numbered from 0 within their distribution
+    """
+    indptr = np.asarray(indptr)
+    lengths = np.diff(indptr)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+    totals = np.bincount(rows, probabilities, minlength=len(lengths))
+    is_empty = (lengths > 0) & ~(totals > 0)
+    if np.any(is_empty):
+        raise ValueError('Distribution ' + str(np.flatnonzero(is_empty)[0]) +
+                         ' has no non-zero probability')
+    scaled = probabilities * (lengths / np.where(totals > 0, totals, 1.0))[rows]
+
+    thresholds = np.ones(len(scaled))
+    aliases = np.arange(len(scaled)) - indptr[rows]
+    is_large = scaled >= 1.0
+    smalls = np.flatnonzero(~is_large)
+    larges = np.flatnonzero(is_large)
+    (small_rows, large_rows) = (rows[smalls], rows[larges])
+    small_starts = np.searchsorted(smalls, indptr[:-1])
+    large_starts = np.searchsorted(larges, indptr[:-1])
+    large_stops = np.searchsorted(larges, indptr[1:])
+    small_stops = np.searchsorted(smalls, indptr[1:])
+
+    # Running sums of the deficits of the small outcomes and of the excesses
+    # of the large ones within each distribution. They are equal at its end.
+    small_positions = np.arange(len(smalls)) - small_starts[small_rows]
+    deficits = _rowCumsum(1.0 - scaled[smalls], small_positions)
+    excesses = _rowCumsum(scaled[larges] - 1.0,
+                          np.arange(len(larges)) - large_starts[large_rows])
+    # The deficit of the small outcomes before each one
+    deficits_before = np.where(small_positions > 0,
+                               deficits[np.maximum(np.arange(len(smalls)) - 1,
+                                                   0)], 0.0)
+
+    # A small outcome falls into the large one that is being filled up when
+    # its turn comes.
+    has_large = (large_stops > large_starts)[small_rows]
+    filled = _searchRows(excesses, large_starts[small_rows],
+                         large_stops[small_rows], deficits_before, 'right')
+    filled = np.clip(filled, large_starts[small_rows],
+                     large_stops[small_rows] - 1)
+    thresholds[smalls[has_large]] = scaled[smalls[has_large]]
+    aliases[smalls[has_large]] = larges[filled[has_large]] - \
+        indptr[small_rows[has_large]]
+
+    # A large outcome ends up below 1/n by the part of the deficit of the
+    # small outcome that filled it up, which goes to the next large one.
+    # The last large outcome of a distribution keeps its whole cell.
+    crossing = _searchRows(deficits, small_starts[large_rows],
+                           small_stops[large_rows], excesses, 'left')
+    is_inside = (excesses > 0.0) & (crossing < small_stops[large_rows])
+    overflows = np.where(is_inside,
+                         np.append(deficits, 0.0)[crossing] - excesses, 0.0)
+    is_passed = np.arange(len(larges)) < large_stops[large_rows] - 1
+    passed = np.flatnonzero(is_passed)
+    thresholds[larges[passed]] = 1.0 - np.clip(overflows[passed], 0.0, 1.0)
+    aliases[larges[passed]] = larges[passed + 1] - indptr[large_rows[passed]]
+
+    return (thresholds, aliases)
+
 
 class EnvWithMDP(Environment):
     
-    def __init__(self,mdp):
+    def __init__(self,mdp,seed=None):
         """Initializes a new environment from a Markov Decision Process.
         
         Here, the environment is simply a wrapper around the MDP, to avoid
         model-free agents from accessing the mdp.
+
+        The non-zero transitions of the MDP get alias tables when the
+        environment is created, see aliasTables(), so that reset() and
+        performAction() sample a next state in O(1), whatever the number of
+        states.
         
         Args:
             mdp : a Markov Decision Process
+            seed : (optional) the seed of the random generator
         """
         self._mdp = mdp
+        self.seed(seed)
+
+        (P, rewards) = mdp.successorTable()
+        self._indptr = P.indptr
+        self._next_states = P.indices
+        self._rewards = rewards
+        (self._thresholds, self._aliases) = aliasTables(P.indptr, P.data)
+
+        I = np.asarray(mdp.I, dtype=np.float64)
+        self._initial_states = np.flatnonzero(I)
+        (self._initial_thresholds, self._initial_aliases) = aliasTables(
+            [0, len(self._initial_states)], I[self._initial_states])
+
         self._prev_state = None # What was the previous state?
         self._cur_state = None  # What was is the current state?
+        self._reward = 0.0      # Reward of going from previous to current
         self.reset()
 
 
@@ -36,24 +196,80 @@ class EnvWithMDP(Environment):
         return self._mdp.isTerminalState(self._cur_state)
 
 
-    def _sample_state(self,probabilities):
-        # probabilities is "probability mass function", e.g. [0 0 0.8 0.2 0 0]
-        
-        # Cumulative distribution function,         e.g. [0 0 0.8 1.0 1.0 1.0]
-        probabilities_cumul = np.cumsum(probabilities)
-        
-        # Find first value large than randomly (uniform) sampled value
-        rand = random.random()
-        for s in range(len(self._mdp.S)):
-            if probabilities_cumul[s]>=rand:
-                return  s
-                
-    
+    def _uniform(self):
+        """ Return a uniform random number in [0, 1). They are drawn from
+        the generator in blocks, which is much faster than one by one.
+        """
+        if not self._uniforms:
+            self._uniforms = self._rng.random(1024).tolist()
+        return self._uniforms.pop()
+
+    def _sampleAlias(self, starts, lengths, thresholds, aliases):
+        """ Sample one outcome of several distributions with alias tables.
+
+        The integer part of a uniform number in [0, length) picks a cell of
+        the table, and its fractional part decides between the cell's own
+        outcome and its alias.
+
+        Returns:
+            the indices of the outcomes in the arrays of the tables
+        """
+        u = self._rng.random(len(starts)) * lengths
+        cells = np.minimum(u.astype(np.intp), lengths - 1)
+        indices = starts + cells
+        is_alias = u - cells >= thresholds[indices]
+        indices[is_alias] = starts[is_alias] + aliases[indices[is_alias]]
+        return indices
+
+    def sampleInitialStates(self, n_samples):
+        """ Sample several initial states, from the initial state
+        distribution I of the MDP.
+
+        Returns:
+            the states, a numpy array of ints of size n_samples
+        """
+        n_initial = len(self._initial_states)
+        indices = self._sampleAlias(
+            np.zeros(n_samples, dtype=np.intp),
+            np.full(n_samples, n_initial), self._initial_thresholds,
+            self._initial_aliases)
+        return self._initial_states[indices]
+
+    def sampleTransitions(self, states, actions):
+        """ Sample the next states of several state/action pairs at once.
+        This does not change the state of the environment.
+
+        Terminal states have no next states: they lead to themselves, with
+        a reward of 0, as in performAction().
+
+        Args:
+            states - the current states, a numpy array of ints
+            actions - the action performed in each of them, a numpy array of
+                ints
+        Returns a tuple with:
+            the next states, a numpy array of ints
+            the rewards, a numpy array of floats
+        """
+        states = np.asarray(states)
+        rows = states * len(self._mdp.A) + np.asarray(actions)
+        starts = self._indptr[rows]
+        lengths = self._indptr[rows + 1] - starts
+        can_act = lengths > 0
+        indices = self._sampleAlias(starts[can_act], lengths[can_act],
+                                    self._thresholds, self._aliases)
+
+        next_states = states.copy()
+        next_states[can_act] = self._next_states[indices]
+        rewards = np.zeros(len(states))
+        rewards[can_act] = self._rewards[indices]
+        return (next_states, rewards)
+
     def reset(self):
         """ See documentation in base class."""
         # Sample random state from initial state distribution
-        self._cur_state = self._sample_state(self._mdp.I)
+        self._cur_state = int(self.sampleInitialStates(1)[0])
         self._prev_state = self._cur_state
+        self._reward = 0.0
 
 
     def performAction(self,cur_action):
@@ -63,21 +279,66 @@ class EnvWithMDP(Environment):
         if isinstance(cur_action, str):
             cur_action = self._mdp.A.index(cur_action)
         
-        # Probability of going to next states, given current state and
-        # action.
-        P_s = self._mdp.P[self._cur_state,cur_action,:]
-  
-        # Sample random state from transition function
-        new_state = self._sample_state(P_s)
+        # The alias table of the non-zero transitions of the current state
+        # and action, see aliasTables(). Terminal states have no next
+        # states, so acting in them has no effect.
+        row = self._cur_state * len(self._mdp.A) + int(cur_action)
+        start = int(self._indptr[row])
+        length = int(self._indptr[row + 1]) - start
+        if length == 0:
+            new_state = self._cur_state
+            self._reward = 0.0
+        else:
+            u = self._uniform() * length
+            cell = min(int(u), length - 1)
+            index = start + cell
+            if u - cell >= self._thresholds[index]:
+                index = start + int(self._aliases[index])
+            new_state = int(self._next_states[index])
+            self._reward = float(self._rewards[index])
         
         # The current becomes the old, and the new becomes the current.
         self._prev_state = self._cur_state
         self._cur_state = new_state
         
         
+    def seed(self, seed=None):
+        """ See documentation in base class."""
+        self._rng = np.random.default_rng(seed)
+        self._uniforms = []
+
+    def getState(self):
+        """ See documentation in base class."""
+        return (self._cur_state, self._prev_state, self._reward,
+                self._rng.bit_generator.state, list(self._uniforms))
+
+    def setState(self, state, restore_random=True):
+        """ See documentation in base class."""
+        (self._cur_state, self._prev_state, self._reward, rng_state,
+         uniforms) = state
+        if restore_random:
+            self._rng.bit_generator.state = rng_state
+            self._uniforms = list(uniforms)
+
+    def rolloutReturns(self, action_sequences, discount=1.0):
+        """ See documentation in base class. All the sequences are stepped
+        at once, with sampleTransitions().
+        """
+        action_sequences = np.asarray(action_sequences)
+        states = np.full(len(action_sequences), self._cur_state)
+        returns = np.zeros(len(action_sequences))
+        weight = 1.0
+        for actions in action_sequences.T:
+            # Terminal states lead to themselves with a reward of 0, so the
+            # finished episodes add nothing more.
+            (states, rewards) = self.sampleTransitions(states, actions)
+            returns += weight * rewards
+            weight *= discount
+        return returns
+
     def getReward(self):
         """ See documentation in base class."""
-        return self._mdp.R[self._prev_state,self._cur_state]
+        return self._reward
     
     def getObservation(self):
         """ See documentation in base class."""
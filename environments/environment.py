@@ -1,3 +1,8 @@
+import copy
+
+import numpy as np
+
+
 class Environment:
     """The interface an environment should conform to."""
 
@@ -62,3 +67,77 @@ class Environment:
         """
         return str(action)
 
+    def seed(self, seed=None):
+        """Give the environment a random number generator of its own.
+        Args:
+            seed (int): The seed of the generator. By default, it is seeded
+                from the operating system.
+        """
+        raise NotImplementedError('subclasses must override seed()!')
+
+    def getState(self):
+        """Save the state of the environment, including the state of its
+        random number generator, e.g. to explore several futures with
+        setState().
+        Returns:
+            The state, an object to pass to setState()
+        """
+        raise NotImplementedError('subclasses must override getState()!')
+
+    def setState(self, state, restore_random=True):
+        """Restore a state saved by getState().
+        Args:
+            state: The state returned by getState()
+            restore_random (bool): Whether to restore the random number
+                generator as well. If not, it goes on from where it is, so
+                that the next steps differ from those after the save.
+        """
+        raise NotImplementedError('subclasses must override setState()!')
+
+    def clone(self, seed=None):
+        """Make a copy of the environment, in the same state, that can be
+        stepped independently. The copy shares the data that steps do not
+        change, so it is cheap. It gets a random number generator of its
+        own, see seed(), so that its future differs from that of the
+        original: restore a state with getState() and setState() to replay
+        the same future instead.
+        Args:
+            seed (int): The seed of the generator of the copy. By default, it
+                is seeded from the operating system.
+        """
+        env = copy.copy(self)
+        env.seed(seed)
+        env.setState(self.getState(), restore_random=False)
+        return env
+
+    def rolloutReturns(self, action_sequences, discount=1.0):
+        """Evaluate several sequences of actions from the current state, e.g.
+        for a planner that looks ahead.
+
+        Each sequence is performed from the current state, until it ends or
+        the episode finishes. The environment is then back in its current
+        state, but its random number generator has moved on, so that calling
+        this again gives new samples.
+
+        Args:
+            action_sequences: The actions, a numpy array of ints of size
+                n_sequences X horizon
+            discount (float): The discount factor of the returns
+        Returns:
+            The discounted return of each sequence, a numpy array of size
+            n_sequences
+        """
+        state = self.getState()
+        returns = np.zeros(len(action_sequences))
+        for (i, actions) in enumerate(action_sequences):
+            self.setState(state, restore_random=False)
+            weight = 1.0
+            for action in actions:
+                if self.isFinished():
+                    break
+                self.performAction(int(action))
+                returns[i] += weight * self.getReward()
+                weight *= discount
+        self.setState(state, restore_random=False)
+        return returns
+
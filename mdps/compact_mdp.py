@@ -0,0 +1,199 @@
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+
+from .markov_decision_process import MarkovDecisionProcess
+
+
+def _transitionGraph(mdp):
+    """ Return the edges s -> s' of the possible transitions of an MDP, for
+    any action, as two numpy arrays of ints (states, next_states).
+    """
+    (P, _) = mdp.successorTable()
+    rows = np.repeat(np.arange(P.shape[0]), np.diff(P.indptr))
+    return (rows // len(mdp.A), P.indices)
+
+
+def _search(sources, targets, start, n_states):
+    """ Find the states that can be reached from the states 'start', following
+    the edges sources[i] -> targets[i].
+
+    Returns:
+        a numpy array of booleans of size n_states
+    """
+    # A breadth first search from an extra node, with an edge to each start
+    # state, visits all the states reachable from any of them at once.
+    start = np.flatnonzero(start)
+    graph = scipy.sparse.csr_matrix(
+        (np.ones(len(sources) + len(start), dtype=bool),
+         (np.concatenate([sources, np.full(len(start), n_states)]),
+          np.concatenate([targets, start]))),
+        shape=(n_states + 1, n_states + 1))
+    order = scipy.sparse.csgraph.breadth_first_order(
+        graph, n_states, directed=True, return_predecessors=False)
+    is_found = np.zeros(n_states + 1, dtype=bool)
+    is_found[order] = True
+    return is_found[:n_states]
+
+
+def reachableStates(mdp):
+    """ Find the states that can be reached from the initial states, i.e.
+    the states s with I(s) > 0.
+
+    Returns:
+        a numpy array of booleans of size len(S)
+    """
+    (states, next_states) = _transitionGraph(mdp)
+    return _search(states, next_states, np.asarray(mdp.I) > 0, len(mdp.S))
+
+
+def goalConnectedStates(mdp):
+    """ Find the states from which a terminal state can be reached.
+
+    Returns:
+        a numpy array of booleans of size len(S)
+    """
+    (states, next_states) = _transitionGraph(mdp)
+    return _search(next_states, states, np.asarray(mdp.T, dtype=bool),
+                   len(mdp.S))
+
+
+class CompactMDP(MarkovDecisionProcess):
+
+    """ The part of an MDP that matters to its solution, with fewer states.
+
+    The states of a CompactMDP are a subset of the states of the original
+    MDP, listed in the array 'states': state i of the compact MDP is state
+    states[i] of the original one. If dead ends were pruned as well, there is
+    one more, terminal, state, to which all transitions into dead ends lead.
+
+    The solutions of the compact MDP are scattered back to the states of the
+    original MDP with expandValues() and expandPolicy(). The string and plot
+    methods do so themselves, and then use those of the original MDP.
+    """
+
+    def __init__(self, mdp, goal_connected=False, dead_end_value=0.0,
+                 fill_value=0.0):
+        """ Compact an MDP.
+
+        Args:
+            mdp - a MarkovDecisionProcess
+            goal_connected - whether to also prune the dead ends, i.e. the
+                states from which no terminal state can be reached. Entering
+                a dead end then ends the episode, as if it were terminal,
+                with a final value of dead_end_value.
+            dead_end_value - the value of the dead ends. If the rewards of a
+                dead end are always r, its true value is r / (1 - discount):
+                with this value, the values of the other states are exact.
+            fill_value - the value given to the unreachable states by
+                expandValues()
+        """
+        self.original = mdp
+        self.dead_end_value = dead_end_value
+        self.fill_value = fill_value
+
+        n_states = len(mdp.S)
+        n_actions = len(mdp.A)
+        is_kept = reachableStates(mdp)
+        self.is_dead_end = np.zeros(n_states, dtype=bool)
+        if goal_connected:
+            self.is_dead_end = is_kept & ~goalConnectedStates(mdp)
+            is_kept &= ~self.is_dead_end
+        self.states = np.flatnonzero(is_kept)
+        n_kept = len(self.states)
+        has_sink = bool(np.any(self.is_dead_end))
+
+        # Index of each original state in the compact MDP, the sink for the
+        # dead ends and -1 for the unreachable states.
+        index = np.full(n_states, -1)
+        index[self.states] = np.arange(n_kept)
+        index[self.is_dead_end] = n_kept
+        n_compact = n_kept + has_sink
+
+        # Keep the rows of the kept states, and renumber their next states.
+        # The rewards depend on the action in general, so R gets the same
+        # layout as P.
+        (P, rewards) = mdp.successorTable()
+        rows = (self.states[:, None] * n_actions +
+                np.arange(n_actions)).ravel()
+        lengths = P.indptr[rows + 1] - P.indptr[rows]
+        new_rows = np.repeat(np.arange(len(rows)), lengths)
+        nonzeros = np.arange(np.sum(lengths)) + \
+            np.repeat(P.indptr[rows] - np.cumsum(lengths) + lengths, lengths)
+        probabilities = P.data[nonzeros]
+        next_states = P.indices[nonzeros]
+        rewards = rewards[nonzeros] + np.where(
+            self.is_dead_end[next_states], mdp.discount * dead_end_value, 0.0)
+        next_states = index[next_states]
+
+        # Several dead ends may merge into the sink: sum their probabilities,
+        # and average their rewards.
+        shape = (n_compact * n_actions, n_compact)
+        P_compact = scipy.sparse.csr_matrix(
+            (probabilities, (new_rows, next_states)), shape=shape)
+        R_compact = scipy.sparse.csr_matrix(
+            (probabilities * rewards, (new_rows, next_states)), shape=shape)
+        R_compact.data /= P_compact.data
+
+        S = list(range(n_compact))
+        T = [bool(mdp.T[s]) for s in self.states] + [True] * has_sink
+        I = np.asarray(mdp.I, dtype=float)
+        I = I[self.states].tolist() + \
+            [float(np.sum(I[self.is_dead_end]))] * has_sink
+        name = mdp.name + ' (compact)'
+        MarkovDecisionProcess.__init__(self, S, T, I, list(mdp.A), P_compact,
+                                       R_compact, mdp.discount, name,
+                                       mdp.dtype)
+
+    def expandValues(self, values):
+        """ Scatter values of the compact MDP to the original states.
+
+        Args:
+            values - a numpy array of size len(S) of the compact MDP
+        Returns:
+            a numpy array of size len(S) of the original MDP, with
+            dead_end_value for the dead ends and fill_value for the
+            unreachable states
+        """
+        expanded = np.full(len(self.original.S), float(self.fill_value))
+        expanded[self.is_dead_end] = self.dead_end_value
+        expanded[self.states] = values[:len(self.states)]
+        return expanded
+
+    def expandPolicy(self, policy):
+        """ Scatter a policy of the compact MDP to the original states.
+
+        Args:
+            policy - a numpy array of size len(S) X len(A) of the compact MDP
+        Returns:
+            a numpy array of size len(S) X len(A) of the original MDP, with
+            uniform action probabilities in the pruned states
+        """
+        n_actions = len(self.A)
+        expanded = np.full((len(self.original.S), n_actions), 1.0 / n_actions)
+        expanded[self.states] = policy[:len(self.states)]
+        return expanded
+
+    def stateString(self, cur_state):
+        """See documentation in the base class."""
+        if cur_state >= len(self.states):
+            return 'dead end'
+        return self.original.stateString(self.states[cur_state])
+
+    def valuesString(self, values):
+        """See documentation in the base class."""
+        return self.original.valuesString(self.expandValues(values))
+
+    def policyStringMode(self, policy):
+        """See documentation in the base class."""
+        return self.original.policyStringMode(self.expandPolicy(policy))
+
+    def policyString(self, policy):
+        """See documentation in the base class."""
+        return self.original.policyString(self.expandPolicy(policy))
+
+    def plotValues(self, ax, values, policy=None):
+        """See documentation in the base class."""
+        if policy is not None:
+            policy = self.expandPolicy(policy)
+        self.original.plotValues(ax, self.expandValues(values), policy)
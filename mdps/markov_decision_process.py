@@ -1,10 +1,88 @@
+import importlib
+import json
+import os
+import shutil
+import tempfile
+
 import numpy as np
 import random
+import scipy.sparse
+
+# Version of the directory format written by MarkovDecisionProcess.save()
+FORMAT_VERSION = 1
+
+
+def _replaceRow(matrix, row, columns, values, merge):
+    """ Return a copy of a CSR matrix with new values in one row.
+
+    Args:
+        matrix - a scipy.sparse CSR matrix
+        row - the index of the row
+        columns, values - the new non-zeros of the row
+        merge - whether to keep the other non-zeros of the row
+    """
+    (start, stop) = (matrix.indptr[row], matrix.indptr[row + 1])
+    columns = np.asarray(columns, dtype=matrix.indices.dtype).ravel()
+    values = np.asarray(values, dtype=matrix.data.dtype).ravel()
+    if merge:
+        is_kept = ~np.isin(matrix.indices[start:stop], columns)
+        columns = np.concatenate([matrix.indices[start:stop][is_kept],
+                                  columns])
+        values = np.concatenate([matrix.data[start:stop][is_kept], values])
+    order = np.argsort(columns, kind='stable')
+
+    indptr = matrix.indptr.copy()
+    indptr[row + 1:] += len(columns) - (stop - start)
+    return scipy.sparse.csr_matrix(
+        (np.concatenate([matrix.data[:start], values[order],
+                         matrix.data[stop:]]),
+         np.concatenate([matrix.indices[:start], columns[order],
+                         matrix.indices[stop:]]),
+         indptr), shape=matrix.shape)
+
+
+def _replaceRows(matrix, rows, replacement):
+    """ Return a copy of a CSR matrix with some rows taken from another.
+
+    The other rows are copied by slices, so the cost is a copy of the
+    non-zeros plus a Python loop over the replaced rows.
+
+    Args:
+        matrix - a scipy.sparse CSR matrix
+        rows - the indices of the rows, a list of ints
+        replacement - a scipy.sparse CSR matrix of the same shape
+    """
+    rows = np.unique(rows)
+    (data, indices) = ([], [])
+    start = 0
+    for row in rows:
+        for (source, first, last) in [(matrix, start, row),
+                                      (replacement, row, row + 1)]:
+            (begin, end) = (source.indptr[first], source.indptr[last])
+            data.append(source.data[begin:end])
+            indices.append(source.indices[begin:end])
+        start = row + 1
+    data.append(matrix.data[matrix.indptr[start]:])
+    indices.append(matrix.indices[matrix.indptr[start]:])
+
+    row_sizes = np.diff(matrix.indptr)
+    row_sizes[rows] = np.diff(replacement.indptr)[rows]
+    indptr = np.concatenate([[0], np.cumsum(row_sizes)])
+    return scipy.sparse.csr_matrix(
+        (np.concatenate(data).astype(matrix.data.dtype, copy=False),
+         np.concatenate(indices).astype(matrix.indices.dtype, copy=False),
+         indptr.astype(matrix.indptr.dtype, copy=False)),
+        shape=matrix.shape)
 
 
 class MarkovDecisionProcess:
 
-    def __init__(self, S, T, I, A, P, R, discount, name='no name'):
+    # Implicit MDPs compute the successors of at most this many state/action
+    # pairs at once, to bound the memory of the temporary arrays.
+    IMPLICIT_BATCH_SIZE = 2**16
+
+    def __init__(self, S, T, I, A, P, R, discount, name='no name',
+                 dtype=np.float64):
         ''' Initialize a Markov Decision Process.
 
         Args:
@@ -14,9 +92,38 @@ class MarkovDecisionProcess:
             R : Reward function,           R: S X S => reward
             T : Terminal states            T: S => boolean
             I : Initial state distribution I: S => probability
+
+        P is either a dense numpy array of size len(S) X len(A) X len(S), or
+        a sparse transition function. A sparse P can be given as a list with
+        one scipy.sparse matrix of size len(S) X len(S) per action, or as a
+        single scipy.sparse matrix of size (len(S)*len(A)) X len(S) whose row
+        s*len(A)+a holds P(s,a,.). Sparse transition functions are stored in
+        the latter form, in CSR format. R may then be a scipy.sparse matrix
+        as well; only its entries for possible transitions are ever read.
+
+        R may also depend on the action, R: S X A X S => reward, when it is
+        given with the same layout as P: a dense numpy array of size
+        len(S) X len(A) X len(S), or a scipy.sparse matrix of size
+        (len(S)*len(A)) X len(S).
+
+        An implicit MDP has P = None and R = None: its transitions are
+        computed on demand, so that its memory does not grow with the number
+        of transitions. Its subclass must then override batchSuccessors().
+
+        dtype is the floating point type of P, R, the tables derived from
+        them, and the values and policies of the solvers. np.float32 halves
+        their memory; sums over many terms are still accumulated in float64.
+        float32 values only have about 7 significant digits, and sweeps stop
+        at a residual of a few units in their last place. Without discount,
+        that residual is multiplied by the number of steps to a terminal
+        state, so iterative policy evaluation sweeps in float64 and only
+        returns float32 values.
         '''
+        self.dtype = np.dtype(dtype)
         self.S = S
         self.A = A
+        self._cache = {}
+        self._edited_states = set()
         self.P = P
         self.R = R
         self.T = T
@@ -24,6 +131,568 @@ class MarkovDecisionProcess:
         self.discount = discount
         self.name = name
 
+    # Solvers and environments read P and R through tables derived from them
+    # (expected rewards, successors, predecessors), which are computed once
+    # and cached. Assigning P or R clears these caches. After modifying P or R
+    # in place, clearCache() must be called.
+
+    @property
+    def P(self):
+        """ The transition function, see __init__()."""
+        return self._P
+
+    @P.setter
+    def P(self, P):
+        if isinstance(P, (list, tuple)):
+            P = self._stackActions(P)
+        elif scipy.sparse.issparse(P):
+            P = scipy.sparse.csr_matrix(P)
+        self._P = self._asDtype(P)
+        self.clearCache()
+
+    @property
+    def R(self):
+        """ The reward function, see __init__()."""
+        return self._R
+
+    @R.setter
+    def R(self, R):
+        self._R = self._asDtype(R)
+        self.clearCache()
+
+    def _asDtype(self, table):
+        """ Convert P or R to the dtype of the MDP, without a copy if it
+        already has it (memory maps then stay memory maps).
+        """
+        if table is None or table.dtype == self.dtype:
+            return table
+        return table.astype(self.dtype)
+
+    def clearCache(self):
+        """ Forget the tables derived from P and R."""
+        self._cache.clear()
+
+    # Edits of a few states are recorded, so that a solution of the MDP
+    # before the edits can be updated by dynamic_programming.
+    # incrementalValueIteration(), rather than recomputed from scratch.
+
+    def markEdited(self, states):
+        """ Record that the transitions or rewards of some states changed.
+
+        Args:
+            states - the edited states, a list or numpy array of ints
+        """
+        self._edited_states.update(int(state) for state in np.ravel(states))
+        self.clearCache()
+
+    def editedStates(self):
+        """ Return the states edited since the last clearEdits(), a sorted
+        numpy array of ints.
+        """
+        return np.array(sorted(self._edited_states), dtype=int)
+
+    def clearEdits(self):
+        """ Forget the edited states."""
+        self._edited_states.clear()
+
+    def setTransitions(self, state, action, next_states, probabilities):
+        """ Replace the transition probabilities P(s,a,.) of one state and
+        action, and record the edit.
+
+        Args:
+            state (int): the state s
+            action (int): the action a
+            next_states - the possible next states, a list of ints
+            probabilities - their probabilities, a list of floats
+        """
+        if self.isImplicit():
+            raise NotImplementedError('implicit MDPs cannot be edited here')
+        if self.isSparse():
+            self._P = _replaceRow(self._P, state * len(self.A) + action,
+                                  next_states, probabilities, merge=False)
+        else:
+            self._P[state, action, :] = 0.0
+            self._P[state, action, next_states] = probabilities
+        self.markEdited([state])
+
+    def setRewards(self, state, next_states, rewards, action=None):
+        """ Replace some rewards R(s,s'), or R(s,a,s') if the rewards depend
+        on the action, and record the edit.
+
+        Args:
+            state (int): the state s
+            next_states - the next states s', a list of ints
+            rewards - their rewards, a list of floats
+            action (int): the action a, if the rewards depend on the action
+        """
+        if self.isImplicit():
+            raise NotImplementedError('implicit MDPs cannot be edited here')
+        if self.rewardsDependOnAction() != (action is not None):
+            raise ValueError('An action must be given if, and only if, the '
+                             'rewards depend on the action')
+        if scipy.sparse.issparse(self._R):
+            row = state if action is None else state * len(self.A) + action
+            self._R = _replaceRow(scipy.sparse.csr_matrix(self._R), row,
+                                  next_states, rewards, merge=True)
+        elif action is None:
+            self._R[state, next_states] = rewards
+        else:
+            self._R[state, action, next_states] = rewards
+        self.markEdited([state])
+
+    def _cached(self, name, compute):
+        """ Return the cached table 'name', computing it first if needed."""
+        if name not in self._cache:
+            self._cache[name] = compute()
+        return self._cache[name]
+
+    def _stackActions(self, P_per_action):
+        """ Convert one sparse S X S matrix per action to a single CSR matrix
+        of size (len(S)*len(A)) X len(S), with row s*len(A)+a for P(s,a,.).
+        """
+        n_states = len(self.S)
+        n_actions = len(self.A)
+        # vstack puts P(s,a,.) in row a*len(S)+s, so reorder the rows.
+        stacked = scipy.sparse.vstack(P_per_action, format='csr')
+        order = np.arange(n_states * n_actions).reshape(n_states, n_actions)
+        order = (order % n_actions) * n_states + order // n_actions
+        return stacked[order.ravel()]
+
+    def isSparse(self):
+        """ Return True if the transition function is stored sparsely."""
+        return scipy.sparse.issparse(self.P)
+
+    def isImplicit(self):
+        """ Return True if the transitions are computed on demand, see
+        batchSuccessors().
+        """
+        return self.P is None
+
+    def transitionMatrix(self):
+        """ Return the transition function as a 2D matrix.
+
+        For an implicit MDP, the matrix is built each time this is called.
+
+        Returns:
+            a numpy array or scipy.sparse CSR matrix of size
+            (len(S)*len(A)) X len(S), whose row s*len(A)+a is P(s,a,.)
+        """
+        if self.isImplicit():
+            return self.successorTable()[0]
+        if self.isSparse():
+            return self.P
+        return self.P.reshape(len(self.S) * len(self.A), len(self.S))
+
+    def successorTable(self):
+        """ Return the non-zero transitions, and their rewards.
+
+        The table is cached, except for implicit MDPs, for which it is built
+        each time this is called.
+
+        Returns a tuple with:
+            the transition function as a scipy.sparse CSR matrix of size
+            (len(S)*len(A)) X len(S), whose row s*len(A)+a is P(s,a,.)
+            the reward of each of its non-zeros, a numpy array aligned with
+            its 'data' array
+        """
+        if self.isImplicit():
+            return self._implicitSuccessorTable()
+        return self._cached('successors', self._computeSuccessorTable)
+
+    def _computeSuccessorTable(self):
+        P = scipy.sparse.csr_matrix(self.transitionMatrix())
+        if np.any(P.data == 0):
+            # Do not modify P itself, which may be a read-only memory map
+            P = P.copy()
+            P.eliminate_zeros()
+        rows = np.repeat(np.arange(P.shape[0]), np.diff(P.indptr))
+        (states, actions) = np.divmod(rows, len(self.A))
+        rewards = self.transitionRewards(states, P.indices, actions)
+        return (P, rewards)
+
+    def _implicitSuccessorTable(self):
+        n_states = len(self.S)
+        n_actions = len(self.A)
+        (states, actions) = np.divmod(np.arange(n_states * n_actions),
+                                      n_actions)
+        (next_states, probabilities, rewards) = \
+            self.batchSuccessors(states, actions)
+        is_possible = probabilities > 0
+        rows = np.broadcast_to(np.arange(len(states))[:, None],
+                               is_possible.shape)[is_possible]
+        next_states = next_states[is_possible]
+        # CSR format needs the next states of each row in increasing order
+        order = np.lexsort((next_states, rows))
+        (rows, next_states) = (rows[order], next_states[order])
+        if np.any((np.diff(rows) == 0) & (np.diff(next_states) == 0)):
+            raise ValueError('batchSuccessors() must not repeat a next state')
+        indptr = np.concatenate(
+            [[0], np.cumsum(np.sum(is_possible, axis=1))])
+        P = scipy.sparse.csr_matrix(
+            (probabilities[is_possible][order], next_states, indptr),
+            shape=(n_states * n_actions, n_states))
+        return (P, rewards[is_possible][order])
+
+    def successors(self, state, action):
+        """ Return the possible next states after an action, with their
+        probabilities and rewards.
+
+        Args:
+            state (int): the current state
+            action (int): the action performed in that state
+        Returns a tuple with:
+            the next states with non-zero probability, a numpy array of ints
+            their probabilities, a numpy array of floats
+            the rewards of going to them, a numpy array of floats
+        """
+        if self.isImplicit():
+            (next_states, probabilities, rewards) = self.batchSuccessors(
+                np.array([state]), np.array([action]))
+            is_possible = probabilities[0] > 0
+            return (next_states[0][is_possible], probabilities[0][is_possible],
+                    rewards[0][is_possible])
+
+        (P, rewards) = self.successorTable()
+        row = state * len(self.A) + action
+        start = P.indptr[row]
+        stop = P.indptr[row + 1]
+        return (P.indices[start:stop], P.data[start:stop],
+                rewards[start:stop])
+
+    def batchSuccessors(self, states, actions):
+        """ Return the possible next states of several state/action pairs,
+        with their probabilities and rewards.
+
+        The successors of pair i are in row i of the returned arrays, padded
+        with zero probabilities to the same number M of columns. Implicit
+        MDPs must override this method; it then defines the MDP.
+
+        Args:
+            states - the current states, a numpy array of ints of size K
+            actions - the action performed in each of them, a numpy array of
+                ints of size K
+        Returns a tuple with:
+            the next states, a numpy array of ints of size K X M
+            their probabilities, a numpy array of floats of size K X M
+            the rewards of going to them, a numpy array of floats of size
+            K X M
+        """
+        if self.isImplicit():
+            raise NotImplementedError(
+                'implicit MDPs must override batchSuccessors()!')
+
+        (P, rewards) = self.successorTable()
+        states = np.asarray(states)
+        rows = states * len(self.A) + np.asarray(actions)
+        starts = P.indptr[rows]
+        lengths = P.indptr[rows + 1] - starts
+        columns = np.arange(max(1, np.max(lengths, initial=0)))
+        is_possible = columns < lengths[:, None]
+
+        # Padding points to the state itself, with a probability of 0
+        next_states = np.repeat(states[:, None], len(columns), axis=1)
+        probabilities = np.zeros(is_possible.shape, dtype=self.dtype)
+        transition_rewards = np.zeros(is_possible.shape, dtype=self.dtype)
+        nonzeros = (starts[:, None] + columns)[is_possible]
+        next_states[is_possible] = P.indices[nonzeros]
+        probabilities[is_possible] = P.data[nonzeros]
+        transition_rewards[is_possible] = rewards[nonzeros]
+        return (next_states, probabilities, transition_rewards)
+
+    def _implicitPairs(self, start=0, stop=None):
+        """ Split the state/action pairs of a block of states into batches.
+
+        Yields tuples with:
+            the offset of the batch in the pairs of the block
+            the states of its pairs, a numpy array of ints
+            the actions of its pairs, a numpy array of ints
+        """
+        n_actions = len(self.A)
+        if stop is None:
+            stop = len(self.S)
+        for first in range(start * n_actions, stop * n_actions,
+                           self.IMPLICIT_BATCH_SIZE):
+            last = min(first + self.IMPLICIT_BATCH_SIZE, stop * n_actions)
+            (states, actions) = np.divmod(np.arange(first, last), n_actions)
+            yield (first - start * n_actions, states, actions)
+
+    def expectedNextValues(self, V, start=0, stop=None):
+        """ Compute the expected value of the next state, for each action in
+        a contiguous block of states.
+
+        E(s,a) = sum_s' P(s,a,s') * V(s')
+
+        Args:
+            V - the values, a numpy array of size len(S), or len(S) X B for
+                B value functions at once
+            start, stop - the block of states (default: all of them)
+
+        Returns:
+            the expected values, a numpy array of size (stop-start) X len(A),
+            or (stop-start) X len(A) X B
+        """
+        n_actions = len(self.A)
+        if stop is None:
+            stop = len(self.S)
+        shape = (stop - start, n_actions) + V.shape[1:]
+
+        if self.isImplicit():
+            expected_values = np.empty(((stop - start) * n_actions,) +
+                                       V.shape[1:],
+                                       dtype=np.result_type(self.dtype, V))
+            for (first, states, actions) in self._implicitPairs(start, stop):
+                (next_states, probabilities, _) = \
+                    self.batchSuccessors(states, actions)
+                expected_values[first:first + len(states)] = np.einsum(
+                    'km,km...->k...', probabilities, V[next_states])
+            return expected_values.reshape(shape)
+
+        P = self.transitionMatrix()[start * n_actions:stop * n_actions]
+        return P.dot(V).reshape(shape)
+
+    def expectedRewards(self):
+        """ Return the expected immediate reward of each state/action pair.
+
+        r(s,a) = sum_s' P(s,a,s') * R(s,s')
+
+        Returns:
+            the expected rewards, a numpy array of size len(S) X len(A)
+        """
+        return self._cached('expected_rewards', self._computeExpectedRewards)
+
+    def _computeExpectedRewards(self):
+        if self.isImplicit():
+            expected_rewards = np.empty(len(self.S) * len(self.A),
+                                        dtype=self.dtype)
+            for (first, states, actions) in self._implicitPairs():
+                (_, probabilities, rewards) = \
+                    self.batchSuccessors(states, actions)
+                expected_rewards[first:first + len(states)] = \
+                    np.sum(probabilities * rewards, axis=1)
+            return expected_rewards.reshape(len(self.S), len(self.A))
+
+        (P, rewards) = self.successorTable()
+        rows = np.repeat(np.arange(P.shape[0]), np.diff(P.indptr))
+        # bincount sums in float64 whatever the dtype of the MDP
+        expected_rewards = np.bincount(rows, weights=P.data * rewards,
+                                       minlength=P.shape[0])
+        return expected_rewards.astype(self.dtype).reshape(len(self.S),
+                                                           len(self.A))
+
+    def predecessors(self):
+        """ Return an index of the states that can lead to each state.
+
+        Returns:
+            a scipy.sparse CSR matrix of size len(S) X len(S). The
+            predecessors of state s are the column indices of its row, i.e.
+            indices[indptr[s]:indptr[s+1]].
+        """
+        return self._cached('predecessors', self._computePredecessors)
+
+    def _computePredecessors(self):
+        n_states = len(self.S)
+        if self.isImplicit():
+            pairs = []
+            for (_, states, actions) in self._implicitPairs():
+                (next_states, probabilities, _) = \
+                    self.batchSuccessors(states, actions)
+                is_possible = probabilities > 0
+                pairs.append((next_states[is_possible],
+                              np.repeat(states, is_possible.sum(axis=1))))
+            (next_states, states) = [np.concatenate(column)
+                                     for column in zip(*pairs)]
+        else:
+            (P, _) = self.successorTable()
+            rows = np.repeat(np.arange(P.shape[0]), np.diff(P.indptr))
+            (next_states, states) = (P.indices, rows // len(self.A))
+        predecessors = scipy.sparse.csr_matrix(
+            (np.ones(len(states), dtype=bool), (next_states, states)),
+            shape=(n_states, n_states))
+        predecessors.sum_duplicates()
+        return predecessors
+
+    def rewardsDependOnAction(self):
+        """ Return True if R has the layout R(s,a,s'), see __init__()."""
+        if self.R is None:
+            return False
+        if scipy.sparse.issparse(self.R):
+            return self.R.shape[0] == len(self.S) * len(self.A) and \
+                len(self.A) > 1
+        return np.ndim(self.R) == 3
+
+    def transitionRewards(self, states, next_states, actions):
+        """ Look up the rewards R(s,a,s') of several transitions.
+
+        Args:
+            states - the states s, a numpy array of ints
+            next_states - the next states s', a numpy array of ints
+            actions - the actions a, a numpy array of ints. They are ignored
+                if the rewards only depend on s and s'.
+        Returns:
+            the rewards, a numpy array of floats
+        """
+        if not self.rewardsDependOnAction():
+            return np.asarray(self.R[states, next_states]).ravel()
+        if scipy.sparse.issparse(self.R):
+            return np.asarray(
+                self.R[states * len(self.A) + actions, next_states]).ravel()
+        return self.R[states, actions, next_states]
+
+    # Attributes stored by save() for all MDPs. The other attributes of
+    # subclasses are stored as well, see _saveAttributes().
+    _SAVED_ATTRIBUTES = ('S', 'A', 'T', 'I', '_P', '_R', 'discount', 'name',
+                         'dtype', '_cache', '_edited_states')
+
+    def save(self, path):
+        """ Save the MDP to a directory, from which load() can memory map it.
+
+        The directory holds a file format.json with the format version, the
+        class, the discount and the other small attributes, and one .npy file
+        per array: P (P_data.npy, P_indices.npy and P_indptr.npy if it is
+        sparse), R, T and I. The arrays of subclasses, e.g. the walls of a
+        grid, are stored as .npy files as well. An existing directory at path
+        is replaced.
+
+        Args:
+            path - the directory to write
+        """
+        parent = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+
+        # Write to a temporary directory first, so that other processes never
+        # load half an MDP.
+        tmp_path = tempfile.mkdtemp(dir=parent, prefix='.tmp')
+        try:
+            def saveArray(name, array):
+                np.save(os.path.join(tmp_path, name + '.npy'), array)
+
+            metadata = {
+                'version': FORMAT_VERSION,
+                'class': [type(self).__module__, type(self).__name__],
+                'name': self.name,
+                'discount': self.discount,
+                'dtype': self.dtype.str,
+                'A': list(self.A),
+                'n_states': len(self.S),
+            }
+            # State spaces are usually range(len(S)), which need not be stored
+            if list(self.S) != list(range(len(self.S))):
+                metadata['S'] = list(self.S)
+
+            for (name, table) in [('P', self.P), ('R', self.R)]:
+                if table is None:
+                    metadata[name] = None
+                elif scipy.sparse.issparse(table):
+                    table = scipy.sparse.csr_matrix(table)
+                    metadata[name] = {'format': 'csr',
+                                      'shape': list(table.shape)}
+                    saveArray(name + '_data', table.data)
+                    saveArray(name + '_indices', table.indices)
+                    saveArray(name + '_indptr', table.indptr)
+                else:
+                    metadata[name] = {'format': 'dense'}
+                    saveArray(name, np.asarray(table))
+            saveArray('T', np.asarray(self.T, dtype=bool))
+            saveArray('I', np.asarray(self.I, dtype=float))
+
+            metadata['attributes'] = self._saveAttributes(saveArray)
+            with open(os.path.join(tmp_path, 'format.json'), 'w') as f:
+                json.dump(metadata, f, indent=2)
+
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.rename(tmp_path, path)
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+    def _saveAttributes(self, saveArray):
+        """ Save the attributes that subclasses add to the MDP.
+
+        Numpy arrays are saved with saveArray(name, array), the other
+        attributes must be JSON serializable.
+
+        Returns:
+            a dictionary with the JSON serializable attributes, and the names
+            of the arrays
+        """
+        attributes = {'json': {}, 'arrays': []}
+        for (name, value) in vars(self).items():
+            if name in self._SAVED_ATTRIBUTES:
+                continue
+            if isinstance(value, np.ndarray):
+                saveArray('attr.' + name, value)
+                attributes['arrays'].append(name)
+            else:
+                try:
+                    json.dumps(value)
+                except TypeError:
+                    raise ValueError('Cannot save attribute "' + name +
+                                     '" of type ' + type(value).__name__)
+                attributes['json'][name] = value
+        return attributes
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """ Load an MDP saved with save().
+
+        The MDP is rebuilt as an instance of the class it was saved from,
+        without calling its __init__().
+
+        Args:
+            path - the directory written by save()
+            mmap - whether to memory map the arrays read-only, rather than to
+                read them. Memory mapped arrays are read on demand, and
+                processes that load the same MDP share one copy of them.
+        Returns:
+            the MDP
+        """
+        with open(os.path.join(path, 'format.json')) as f:
+            metadata = json.load(f)
+        if metadata.get('version') != FORMAT_VERSION:
+            raise ValueError('Unsupported MDP format version ' +
+                             str(metadata.get('version')) + ' in ' + path)
+
+        (module, name) = metadata['class']
+        mdp_class = getattr(importlib.import_module(module), name)
+        if not issubclass(mdp_class, cls):
+            raise TypeError(path + ' holds a ' + name + ', not a ' +
+                            cls.__name__)
+
+        mmap_mode = 'r' if mmap else None
+
+        def loadArray(name):
+            return np.load(os.path.join(path, name + '.npy'),
+                           mmap_mode=mmap_mode)
+
+        tables = {}
+        for table in ['P', 'R']:
+            info = metadata[table]
+            if info is None:
+                tables[table] = None
+            elif info['format'] == 'csr':
+                tables[table] = scipy.sparse.csr_matrix(
+                    (loadArray(table + '_data'), loadArray(table + '_indices'),
+                     loadArray(table + '_indptr')),
+                    shape=tuple(info['shape']), copy=False)
+            else:
+                tables[table] = loadArray(table)
+
+        S = metadata.get('S', range(metadata['n_states']))
+        mdp = mdp_class.__new__(mdp_class)
+        MarkovDecisionProcess.__init__(
+            mdp, S, loadArray('T'), loadArray('I'), metadata['A'],
+            tables['P'], tables['R'], metadata['discount'], metadata['name'],
+            np.dtype(metadata.get('dtype', 'float64')))
+
+        attributes = metadata['attributes']
+        for (name, value) in attributes['json'].items():
+            setattr(mdp, name, value)
+        for name in attributes['arrays']:
+            setattr(mdp, name, loadArray('attr.' + name))
+        return mdp
+
     def isTerminalState(self, state):
         """Determine whether a state is terminal or not.
 
@@ -41,9 +710,14 @@ class MarkovDecisionProcess:
         string += '  T  (terminal states)            = ' + str(self.T) + '\n'
         string += '  I  (initial state distribution) = ' + str(self.I) + '\n'
         string += '  A  (action space)               = ' + str(self.A) + '\n'
+        if self.isImplicit():
+            return string + '  P, R implicit\n'
         for a in range(len(self.A)):
             string += '  P_' + str(a) + '=\n'
-            string += '' + str(self.P[:, a, :])
+            if self.isSparse():
+                string += '' + str(self.P[a::len(self.A)])
+            else:
+                string += '' + str(self.P[:, a, :])
             string += '\n'
         string += '  R=\n' + str(self.R) + '\n'
 
@@ -1,13 +1,16 @@
 import numpy as np
+import scipy.sparse
 from matplotlib import pyplot as plt
 
-from .markov_decision_process import MarkovDecisionProcess
+from .markov_decision_process import MarkovDecisionProcess, _replaceRows
 
 
 class MDPGrid(MarkovDecisionProcess):
     """Markov Decision Process for a 2D Grid."""
 
-    def __init__(self, n_rows=3, n_cols=4, stochasticity=0.0, discount=1.0):
+    def __init__(self, n_rows=3, n_cols=4, stochasticity=0.0, discount=1.0,
+                 sparse=False, terminals=None, is_wall=None, implicit=False,
+                 bump_penalty=-1.0, dtype=np.float64):
         """ Initialize a 2D Grid MDP.
 
         Args:
@@ -18,6 +21,25 @@ class MDPGrid(MarkovDecisionProcess):
                 example stochasticity = 0.2 : there is a 0.2 change that an
                 action has no effect (i.e. the agent stays where it is)
             discount (float) : discount factor
+            sparse (bool) : whether to store the transition and reward
+                functions as sparse matrices. Their size then grows with the
+                number of states, rather than with its square.
+            terminals (list of int) : the terminal states. By default, only
+                the first state (top left cell) is terminal.
+            is_wall (array of bool) : which cells are walls, of size
+                n_rows X n_cols. Moving into a wall has no effect, like moving
+                out of the grid. Walls have no transitions, and are never
+                initial states.
+            implicit (bool) : whether to compute the transitions on demand
+                instead of storing P and R, see batchSuccessors(). The memory
+                of the MDP then only grows linearly with the number of
+                states, whatever the size of the grid.
+            bump_penalty (float) : reward for bumping into a wall or the edge
+                of the grid. The rewards then depend on the action, see
+                MarkovDecisionProcess.__init__(), unless this is -1, the
+                reward of any other move.
+            dtype : floating point type of P, R and the values of the
+                solvers, see MarkovDecisionProcess.__init__()
         """
         name = "Grid"
 
@@ -32,83 +54,322 @@ class MDPGrid(MarkovDecisionProcess):
             A = ['LEFT', 'RIGHT', 'UP', 'DOWN']
         n_actions = len(A)
 
-        # Transition function S x A x S -> probability
-        P = np.zeros((n_states, n_actions, n_states,))
-        for i_row in range(n_rows):
-            for i_col in range(n_cols):
-                s = i_row*n_cols + i_col
-                #          col
-                #       1  2  3  4
-                #
-                # r 1   1  2  3  4
-                # o 2   5  6  7  8 state 's'
-                # w 3   9 10 11 12
-                #
-
-                # Here come the transitions for the 'LEFT' action
-                LEFT = 0
-                if i_col > 0:
-                    P[s, LEFT, s-1] = 1.0-stochasticity  # Successful move LEFT
-                    P[s, LEFT, s] = stochasticity  # Fail: stayed where you are
-                else:
-                    P[s, LEFT, s] = 1.0  # Always bumps into wall on far left
-
-                # Here come the transitions for the 'RIGHT' action
-                RIGHT = 1
-                if i_col < (n_cols-1):
-                    P[s, RIGHT, s+1] = 1.0-stochasticity  # Successful move RIGHT
-                    P[s, RIGHT, s] = stochasticity  # Fail: stayed where you are
-                else:
-                    P[s, RIGHT, s] = 1.0  # Always bumps into wall on far left 
-
-                if n_actions > 2:
-                    # Here come the transitions for the 'UP' action
-                    UP = 2
-                    if i_row > 0:
-                        P[s, UP, s-n_cols] = 1.0-stochasticity  # Successful move UP
-                        P[s, UP, s] = stochasticity  # Fail: stayed where you are
-                    else:
-                        P[s, UP, s] = 1.0  # Always bumps into wall on far left 
-
-                    # Here come the transitions for the 'RIGHT' action
-                    DOWN = 3
-                    if i_row < (n_rows-1):
-                        P[s, DOWN, s+n_cols] = 1.0-stochasticity  # Successful move
-                        P[s, DOWN, s] = stochasticity  # Fail: stayed where you are
-                    else:
-                        P[s, DOWN, s] = 1.0  # Always bumps into wall on far left 
+        #          col
+        #       1  2  3  4
+        #
+        # r 1   1  2  3  4
+        # o 2   5  6  7  8 state 's'
+        # w 3   9 10 11 12
+        #
+        if is_wall is None:
+            is_wall = np.zeros(n_states, dtype=bool)
+        else:
+            is_wall = np.asarray(is_wall, dtype=bool).reshape(n_states)
 
         # Terminal states (not probabilities, but true/false)
-        T = [False] * n_states
-        T[0] = True # First state is a terminal state
+        if terminals is None:
+            terminals = [0]  # First state is a terminal state
+        is_terminal = np.zeros(n_states, dtype=bool)
+        is_terminal[terminals] = True
+        if np.any(is_terminal & is_wall):
+            raise ValueError('A terminal state cannot be a wall')
+        T = is_terminal.tolist()
 
         # Initial state distribution: uniform over all states except the
-        # terminal state.
-        n_nonterminal_states = n_states - sum(T);
-        I = [ float(1-terminal)/float(n_nonterminal_states) for terminal in T]
-  
-  
-        # For terminal states, the probability of going to another state is
-        # 0. This is obvious, but needs to be explicitly set, otherwise some
-        # of the recursive equations will not work properly.
-        for s in S:
-            if T[s]:
-                P[s,:,:] = 0
-  
-        # Reward function
-        R = np.full((n_states,n_states,), -1.0) 
-        for s in S:
-            if T[s]:
-                R[:,s] = 100.0 # If you go to a terminal state, reward of 100.
+        # terminal states and the walls.
+        is_initial = ~(is_terminal | is_wall)
+        I = (is_initial / float(np.sum(is_initial))).tolist()
+
+        self.dtype = np.dtype(dtype)
+        self.n_rows = n_rows
+        self.n_cols = n_cols
+        self.stochasticity = stochasticity  # A number, or one per state
+        self.bump_penalty = bump_penalty
+        self.is_wall = is_wall  # Boolean numpy array of size len(S)
+        self._is_terminal = is_terminal
+
+        # Transition function S x A x S -> probability
+        # The cell an agent moves to is computed for all states and actions
+        # at once. These targets are all _gridSuccessors() needs, so an
+        # implicit grid only stores them.
+        self._targets = self._moveTargets(np.arange(n_states), n_actions)
+        # For terminal states (and walls), the probability of going to
+        # another state is 0. This is obvious, but needs to be explicitly
+        # set, otherwise some of the recursive equations will not work
+        # properly.
+        self._can_act = is_initial
+
+        if implicit:
+            (P, R) = (None, None)
+        else:
+            (P, R) = self._transitionTables(sparse)
 
         # Create the MDP by calling __init__ in the base class
         # MarkovDecisionProcess
         # I have kept this compatible with both Python 2 and 3
-        MarkovDecisionProcess.__init__(self,S,T,I,A,P,R,discount,name)
+        MarkovDecisionProcess.__init__(self,S,T,I,A,P,R,discount,name,dtype)
 
-        self.n_rows = n_rows
-        self.n_cols = n_cols
-        self.is_wall = None
+    def _moveTargets(self, states, n_actions):
+        """ Compute the cell that each action moves to from some states.
+
+        Moving out of the grid or into a wall is a bump: the agent stays
+        where it is.
+
+        Returns:
+            the target states, a numpy array of ints of size
+            len(states) X n_actions
+        """
+        (i_rows, i_cols) = np.divmod(states, self.n_cols)
+        moves = [(i_cols > 0, -1),  # LEFT
+                 (i_cols < self.n_cols - 1, +1),  # RIGHT
+                 (i_rows > 0, -self.n_cols),  # UP
+                 (i_rows < self.n_rows - 1, +self.n_cols)]  # DOWN
+        targets = np.empty((len(states), n_actions), dtype=np.intp)
+        for action, (is_inside, offset) in enumerate(moves[:n_actions]):
+            targets[:, action] = np.where(is_inside, states + offset, states)
+        return np.where(self.is_wall[targets], states[:, None], targets)
+
+    def setWalls(self, states, is_wall=True):
+        """ Add or remove walls, and record the edited states.
+
+        Args:
+            states - the cells, a list of ints
+            is_wall (bool) : whether they become walls or free cells
+        """
+        states = np.atleast_1d(states)
+        if is_wall and np.any(self._is_terminal[states]):
+            raise ValueError('A terminal state cannot be a wall')
+        self.is_wall[states] = is_wall
+        self._editCells(states)
+
+    def setTerminals(self, states, is_terminal=True):
+        """ Make cells terminal or not, and record the edited states.
+
+        Args:
+            states - the cells, a list of ints
+            is_terminal (bool) : whether they become terminal
+        """
+        states = np.atleast_1d(states)
+        if is_terminal and np.any(self.is_wall[states]):
+            raise ValueError('A terminal state cannot be a wall')
+        self._is_terminal[states] = is_terminal
+        for state in states:
+            self.T[state] = bool(is_terminal)
+        self._editCells(states)
+
+    def setStochasticity(self, states, stochasticity):
+        """ Change the stochasticity of some cells, and record the edited
+        states. The stochasticity of the grid then becomes an array with one
+        value per state.
+
+        Args:
+            states - the cells, a list of ints
+            stochasticity (float) : their new level of stochasticity
+        """
+        states = np.atleast_1d(states)
+        self.stochasticity = np.array(
+            np.broadcast_to(self.stochasticity, (len(self.S),)), dtype=float)
+        self.stochasticity[states] = stochasticity
+        self._editCells(states, neighbours=False)
+
+    def setTransitions(self, state, action, next_states, probabilities):
+        """ Not supported: the transitions of a grid follow from its
+        cells, which the 'stencil' solvers read instead of P, and which the
+        edits below rebuild P from. Edit the cells instead.
+        """
+        raise NotImplementedError('The transitions of an MDPGrid cannot be '
+                                  'set; use setWalls(), setTerminals() or '
+                                  'setStochasticity()')
+
+    def setRewards(self, state, next_states, rewards, action=None):
+        """ Not supported, see setTransitions()."""
+        raise NotImplementedError('The rewards of an MDPGrid cannot be set; '
+                                  'use setWalls(), setTerminals() or '
+                                  'setStochasticity()')
+
+    def _editCells(self, states, neighbours=True):
+        """ Update the transitions after an edit of some cells.
+
+        Walls and terminal cells also change the transitions or rewards of
+        moving into them, so the neighbours of the cells are edited as well.
+        Explicit grids only rebuild the rows of P and R of these states, see
+        _updateTransitionTables().
+        """
+        n_actions = len(self.A)
+        if neighbours:
+            (i_rows, i_cols) = np.divmod(states, self.n_cols)
+            neighbours = [states[i_cols > 0] - 1,
+                          states[i_cols < self.n_cols - 1] + 1,
+                          states[i_rows > 0] - self.n_cols,
+                          states[i_rows < self.n_rows - 1] + self.n_cols]
+            states = np.unique(np.concatenate([states] +
+                                              neighbours[:n_actions]))
+
+        self._targets[states] = self._moveTargets(states, n_actions)
+        self._can_act = ~(self._is_terminal | self.is_wall)
+        self.I = (self._can_act / float(np.sum(self._can_act))).tolist()
+        if not self.isImplicit():
+            self._updateTransitionTables(states)
+        self.markEdited(states)
+
+    def _updateTransitionTables(self, states):
+        """ Rebuild the rows of P and R of some states, and the columns of
+        R of the same states, whose reward may have changed.
+
+        The successors of the other states are not computed again, so an
+        edit of a few cells stays cheap on a large grid. Dense tables are
+        updated in place; sparse ones are copied, with the rows of the other
+        states copied in one vectorized pass.
+        """
+        n_actions = len(self.A)
+        if self.isSparse():
+            (P, R) = self._transitionTables(True, states)
+            rows = (states[:, None] * n_actions +
+                    np.arange(n_actions)).ravel()
+            self._P = _replaceRows(self._P, rows, P)
+            if not self.rewardsDependOnAction():
+                rows = states
+            self._R = _replaceRows(scipy.sparse.csr_matrix(self._R), rows, R)
+            return
+
+        (sources, actions, next_states, probabilities, rewards) = \
+            self._possibleTransitions(states[self._can_act[states]])
+        self._P[states] = 0.0
+        self._P[sources, actions, next_states] = probabilities
+        default_rewards = np.where(self._is_terminal, 100.0, -1.0)
+        self._R[..., states] = default_rewards[states]
+        if self.rewardsDependOnAction():
+            self._R[states] = default_rewards
+            self._R[sources, actions, next_states] = rewards
+
+    def _possibleTransitions(self, sources):
+        """ List the transitions of some states with a non-zero probability.
+
+        Returns a tuple with numpy arrays of the same size:
+            the states, the actions and the next states
+            the probabilities and the rewards of the transitions
+        """
+        n_actions = self._targets.shape[1]
+        states = np.repeat(sources, n_actions)
+        actions = np.tile(np.arange(n_actions), len(sources))
+        (next_states, probabilities, rewards) = \
+            self._gridSuccessors(states, actions)
+        is_possible = probabilities > 0
+        return (np.repeat(states, is_possible.sum(axis=1)),
+                np.repeat(actions, is_possible.sum(axis=1)),
+                next_states[is_possible], probabilities[is_possible],
+                rewards[is_possible])
+
+    def _transitionTables(self, sparse, states=None):
+        """ Build P and R from the successors of all states.
+
+        Args:
+            sparse (bool) : whether to build sparse tables
+            states - (optional) only fill the rows of these states, a numpy
+                array of ints, see _updateTransitionTables()
+
+        Returns a tuple with:
+            P, a numpy array of size len(S) X len(A) X len(S), or a sparse
+            CSR matrix of size (len(S)*len(A)) X len(S) if sparse is True
+            R, a numpy array or CSR matrix of size len(S) X len(S), or with
+            the layout of P if the rewards depend on the action
+        """
+        n_states = len(self._is_terminal)
+        n_actions = self._targets.shape[1]
+        if states is None:
+            sources = np.flatnonzero(self._can_act)
+        else:
+            sources = states[self._can_act[states]]
+        (states, actions, next_states, probabilities, rewards) = \
+            self._possibleTransitions(sources)
+
+        rows = states*n_actions + actions
+        if sparse:
+            P = scipy.sparse.csr_matrix(
+                (probabilities, (rows, next_states)),
+                shape=(n_states*n_actions, n_states))
+        else:
+            P = np.zeros((n_states, n_actions, n_states,), dtype=self.dtype)
+            P[states, actions, next_states] = probabilities
+
+        # Reward function
+        # If you go to a terminal state, reward of 100, otherwise -1.
+        # Bumping may be penalized differently, see _gridSuccessors(), and
+        # then the rewards depend on the action.
+        is_terminal = self._is_terminal
+        if self.bump_penalty != -1.0 and sparse:
+            R = scipy.sparse.csr_matrix(
+                (rewards, (rows, next_states)),
+                shape=(n_states*n_actions, n_states))
+        elif self.bump_penalty != -1.0:
+            R = np.full((n_states, n_actions, n_states,), -1.0,
+                        dtype=self.dtype)
+            R[:, :, is_terminal] = 100.0
+            R[states, actions, next_states] = rewards
+        elif sparse:
+            # Only store the rewards of the possible transitions
+            # (the duplicates of the (s, s') pairs are merged in CSR format).
+            R = scipy.sparse.csr_matrix(
+                (np.ones(len(states), dtype=self.dtype),
+                 (states, next_states)),
+                shape=(n_states, n_states))
+            R.sum_duplicates()
+            R.data = np.where(is_terminal[R.indices], 100.0,
+                              -1.0).astype(self.dtype)
+        else:
+            R = np.full((n_states,n_states,), -1.0, dtype=self.dtype)
+            R[:, is_terminal] = 100.0
+        return (P, R)
+
+    def batchSuccessors(self, states, actions):
+        """See documentation in the base class.
+
+        The successors of an implicit grid are computed from the target cell
+        of each move, see _gridSuccessors(). Explicit grids use P.
+        """
+        if not self.isImplicit():
+            return MarkovDecisionProcess.batchSuccessors(self, states, actions)
+        return self._gridSuccessors(states, actions)
+
+    def _gridSuccessors(self, states, actions):
+        """ Compute the successors of some states and actions from the
+        parameters of the grid, without P. See batchSuccessors().
+        """
+        states = np.asarray(states)
+        targets = self._targets[states, np.asarray(actions)]
+        moved = targets != states
+        can_act = self._can_act[states]
+
+        stochasticity = self.stochasticity
+        if np.ndim(stochasticity) > 0:
+            stochasticity = stochasticity[states]
+
+        # Successful move (or a bump with probability 1), and failed move
+        next_states = np.stack([targets, states], axis=1)
+        probabilities = np.stack(
+            [np.where(moved, 1.0 - stochasticity, 1.0),
+             np.where(moved, stochasticity, 0.0)], axis=1)
+        probabilities *= can_act[:, None]
+        rewards = np.where(self._is_terminal[next_states], 100.0, -1.0)
+        if self.bump_penalty != -1.0:
+            # A bump and a failed move both leave the agent where it is, so
+            # their transition gets the mean of their rewards.
+            rewards[:, 0] = np.where(
+                moved, rewards[:, 0], stochasticity * -1.0 +
+                (1.0 - stochasticity) * self.bump_penalty)
+        rewards[probabilities == 0] = 0.0
+        return (next_states, probabilities.astype(self.dtype, copy=False),
+                rewards.astype(self.dtype, copy=False))
+
+    def _cellString(self, s):
+        """ Return the 8 character cell of a wall or terminal state, or None
+        for other states.
+        """
+        if self.is_wall[s]:
+            return '      # '
+        if self.isTerminalState(s):
+            return '      T '
+        return None
 
     def stateString(self,cur_state):
         """See documentation in the base class."""
@@ -119,7 +380,9 @@ class MDPGrid(MarkovDecisionProcess):
                 s = i_row*self.n_cols + i_col
                 if s==cur_state:
                     string += 'A '
-                else:   
+                elif self.is_wall[s]:
+                    string += '# '
+                else:
                     string += '. '
             string += '|'
             if i_row<(self.n_rows-1):
@@ -134,8 +397,9 @@ class MDPGrid(MarkovDecisionProcess):
             string += '| '
             for i_col in range(self.n_cols):
                 s = i_row*self.n_cols + i_col
-                if self.isTerminalState(s):
-                    string += '      T '
+                cell = self._cellString(s)
+                if cell is not None:
+                    string += cell
                 else:
                     string += '{: > 7.2f} '.format(values[s])
             string += '|'
@@ -152,8 +416,9 @@ class MDPGrid(MarkovDecisionProcess):
             string += '| '
             for i_col in range(self.n_cols):
                 s = i_row*self.n_cols + i_col
-                if self.isTerminalState(s):
-                    string += '      T '
+                cell = self._cellString(s)
+                if cell is not None:
+                    string += cell
                 else:
                     action = np.argmax(policy[s,:])
                     string += '{: >7} '.format(self.A[action])
@@ -172,8 +437,9 @@ class MDPGrid(MarkovDecisionProcess):
                 string += '| '
                 for i_col in range(self.n_cols):
                     s = i_row*self.n_cols + i_col
-                    if self.isTerminalState(s):
-                        string += '      T '
+                    cell = self._cellString(s)
+                    if cell is not None:
+                        string += cell
                     else:
                         string += '{: > 7.2f} '.format(policy[s,action])
                         #action = np.argmax(policy[s,:])
@@ -21,9 +21,24 @@ def _test_mdps():
     mdp = MDPGrid(n_rows, n_cols, stochasticity)
     print(mdp)
 
+    print('____________________________________________')
+    mdp = MDPGrid(n_rows, n_cols, stochasticity, sparse=True)
+    print(mdp)
+
+    # Save the MDP and memory map it back
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        mdp.save(directory + '/grid')
+        print(MDPGrid.load(directory + '/grid'))
+    finally:
+        shutil.rmtree(directory)
+
 
 def _test_environments():
 
+    import numpy as np
     import environments
     from environments.env_maze import EnvMaze
 
@@ -46,6 +61,71 @@ def _test_environments():
     maze.performAction('UP')
     print(maze.stateString())
 
+    # Many copies of the maze are stepped at once
+    from environments.env_maze_batch import EnvMazeBatch
+    batch = EnvMazeBatch(char_grid, stochasticity, bump_penalty, n_envs=1000)
+    (observations, rewards, dones) = batch.step(
+        np.random.randint(batch.numActions(), size=batch.n_envs))
+    print(observations.shape, rewards.dtype, dones.dtype)
+
+    # An MDP environment samples many transitions in one call
+    from environments.env_with_mdp import EnvWithMDP
+    env = EnvWithMDP(maze.toMDP())
+    states = env.sampleInitialStates(1000)
+    (next_states, rewards) = env.sampleTransitions(
+        states, np.random.randint(env.numActions(), size=len(states)))
+    print(next_states.shape, rewards.dtype)
+
+    # A planner evaluates action sequences from a saved state
+    for planned in [maze, env]:
+        state = planned.getState()
+        returns = planned.rolloutReturns(
+            np.random.randint(planned.numActions(), size=(100, 20)), 0.9)
+        planned.clone().performAction(0)
+        planned.setState(state)
+        print(returns.shape, planned.getObservation())
+
+    # A restored state replays the same future, while clones draw their own
+    actions = np.random.randint(4, size=30)
+    for planned in [EnvMaze(char_grid, 0.5, seed=1),
+                    EnvWithMDP(EnvMaze(char_grid, 0.5).toMDP(), seed=1)]:
+        state = planned.getState()
+        futures = []
+        for stepped in [planned, planned, planned.clone(), planned.clone()]:
+            planned.setState(state)
+            future = []
+            for action in actions:
+                stepped.performAction(int(action))
+                future.append(stepped.getObservation())
+            futures.append(future)
+        print(futures[0] == futures[1], futures[0] != futures[2],
+              futures[2] != futures[3])
+
+    # Copies of any environment are stepped by worker processes
+    import functools
+    from environments.env_subprocess_vector import EnvSubprocessVector
+    factory = functools.partial(EnvMaze, char_grid, stochasticity,
+                                bump_penalty)
+    with EnvSubprocessVector(factory, 8, n_workers=2, seed=0) as vector:
+        vector.stepAsync(np.random.randint(vector.numActions(), size=8))
+        (observations, rewards, dones) = vector.stepWait()
+        print(observations.shape, rewards.dtype, dones.dtype)
+
+    # The same seed gives the same steps, whatever the number of workers
+    actions = np.random.randint(4, size=(10, 8))
+    runs = []
+    for n_workers in [2, 3]:
+        with EnvSubprocessVector(factory, 8, n_workers, seed=0) as vector:
+            runs.append([vector.step(step_actions)[0]
+                         for step_actions in actions])
+    print(np.array_equal(runs[0], runs[1]))
+
+    # The maze compiled into an MDP can be solved exactly
+    from dynamic_programming import valueIteration
+    mdp = maze.toMDP(discount=0.9)
+    (V, policy) = valueIteration(mdp)
+    print(mdp.valuesString(V))
+
     from get_environment_from_name import get_environment_from_name
 
     names = ['FlipCoin', 'FlipTwoCoins', 'Grid', 'Maze']
@@ -73,6 +153,140 @@ def _test_environments():
             env.performAction('UP')
 
 
+def _test_dynamic_programming():
+
+    import numpy as np
+    from dynamic_programming import policyEvaluation, valueIteration
+    from dynamic_programming import policyIteration, modifiedPolicyIteration
+    from dynamic_programming import prioritizedValueIteration
+    from dynamic_programming import multigridValueIteration
+    from dynamic_programming import incrementalValueIteration
+    from dynamic_programming import finiteHorizonValueIteration
+    from dynamic_programming import batchPolicyEvaluation, SolverTrace
+    from mdps.mdp_grid import MDPGrid
+
+    print('____________________________________________')
+    mdp = MDPGrid(4, 5, 0.1, 0.9)
+    n_states = len(mdp.S)
+    n_actions = len(mdp.A)
+    policy = np.full((n_states, n_actions), 1.0 / n_actions)
+
+    # Jacobi and Gauss-Seidel sweeps must converge to the same fixed point
+    V_jacobi = policyEvaluation(mdp, policy, epsilon=1e-8)
+    V_gauss_seidel = policyEvaluation(mdp, policy, epsilon=1e-8,
+                                      sweep='gauss-seidel', block_size=3)
+    print(np.max(np.abs(V_jacobi - V_gauss_seidel)))
+
+    # The exact solution of the linear system must match the sweeps
+    V_direct = policyEvaluation(mdp, policy, method='direct')
+    print(np.max(np.abs(V_jacobi - V_direct)))
+
+    # A batch of the same policy with the MDP's discount must match it
+    (V_batch, converged) = batchPolicyEvaluation(
+        mdp, [policy, policy], [mdp.discount, 0.5], epsilon=1e-8)
+    print(np.max(np.abs(V_batch[0] - V_direct)), converged)
+
+    trace = SolverTrace()
+    (V_jacobi, _) = valueIteration(mdp, epsilon=1e-8, trace=trace)
+    print(trace)
+    (V_gauss_seidel, _) = valueIteration(mdp, epsilon=1e-8,
+                                         sweep='gauss-seidel', block_size=1)
+    print(np.max(np.abs(V_jacobi - V_gauss_seidel)))
+    print(mdp.valuesString(V_jacobi))
+
+    # A cache miss solves and stores, a hit returns the same writable
+    # arrays, and another discount starts from the stored values
+    import shutil
+    import tempfile
+    from solution_cache import SolutionCache
+    directory = tempfile.mkdtemp()
+    try:
+        cache = SolutionCache(directory)
+        (V_miss, policy_miss) = valueIteration(mdp, epsilon=1e-8, cache=cache)
+        (V_hit, policy_hit) = valueIteration(mdp, epsilon=1e-8, cache=cache)
+        V_hit[0] = 0.0
+        print(np.array_equal(V_miss[1:], V_hit[1:]),
+              np.array_equal(policy_miss, policy_hit))
+        (cold, warm) = (SolverTrace(), SolverTrace())
+        other_mdp = MDPGrid(4, 5, 0.1, 0.8)
+        valueIteration(other_mdp, epsilon=1e-8, trace=cold)
+        valueIteration(other_mdp, epsilon=1e-8, cache=cache, trace=warm)
+        print(warm.numIterations() < cold.numIterations())
+        # A solve stopped by the callback is not stored as the solution
+        valueIteration(mdp, epsilon=1e-6, cache=cache,
+                       callback=lambda iteration, V, residual: iteration >= 2)
+        (V_stopped, _) = valueIteration(mdp, epsilon=1e-6, cache=cache)
+        print(np.max(np.abs(V_stopped - valueIteration(mdp, epsilon=1e-6)[0])))
+    finally:
+        shutil.rmtree(directory)
+
+    # Sweeps split over worker processes must give the serial values
+    # The callback gets copies, which outlive the shared memory of the sweeps
+    kept = []
+    (V_parallel, _) = valueIteration(
+        mdp, epsilon=1e-8, n_workers=2,
+        callback=lambda iteration, V, residual: kept.append(V))
+    print(np.max(np.abs(V_jacobi - V_parallel)),
+          np.max(np.abs(kept[-1] - V_parallel)))
+
+    # An implicit grid never stores P, but must have the same values
+    (V_implicit, _) = valueIteration(
+        MDPGrid(4, 5, 0.1, 0.9, implicit=True), epsilon=1e-8)
+    print(np.max(np.abs(V_jacobi - V_implicit)))
+    # float32 tables and values only lose about 7 significant digits
+    (V_float32, _) = valueIteration(
+        MDPGrid(4, 5, 0.1, 0.9, dtype=np.float32), epsilon=1e-8)
+    print(V_float32.dtype, np.max(np.abs(V_jacobi - V_float32)))
+    # Without discount, float32 policy evaluation must still match the
+    # exact solution, about 570 here, to its last places
+    undiscounted = MDPGrid(10, 10, 0.1, 1.0, dtype=np.float32)
+    uniform = np.full((100, n_actions), 1.0 / n_actions)
+    V_exact = policyEvaluation(undiscounted, uniform, method='direct')
+    print(np.max(np.abs(
+        policyEvaluation(undiscounted, uniform, 100000, epsilon=1e-8) -
+        V_exact)))
+    (V_batch, converged) = batchPolicyEvaluation(
+        undiscounted, [uniform, uniform], n_iterations=100000, epsilon=1e-8)
+    print(V_batch.dtype, np.max(np.abs(V_batch - V_exact)), converged)
+    (V_stencil, _) = valueIteration(mdp, epsilon=1e-8, sweep='stencil')
+    print(np.max(np.abs(V_jacobi - V_stencil)))
+    (V_multigrid, _, n_sweeps) = multigridValueIteration(
+        MDPGrid(40, 50, 0.1, 0.9), epsilon=1e-8)
+    print(n_sweeps)
+
+    # With a long horizon, backward induction reaches the stationary values
+    (V_horizon, actions) = finiteHorizonValueIteration(mdp, 500)
+    print(np.max(np.abs(V_jacobi - V_horizon[0])), actions.dtype)
+
+    # Pruning the states that cannot be reached must not change the values
+    from mdps.compact_mdp import CompactMDP
+    compact_mdp = CompactMDP(mdp)
+    (V_compact, _) = valueIteration(compact_mdp, epsilon=1e-8)
+    print(np.max(np.abs(V_jacobi - compact_mdp.expandValues(V_compact))))
+
+    # Policy iteration must find the same values, and a deterministic policy
+    (V_policy_iteration, policy) = policyIteration(mdp)
+    print(np.max(np.abs(V_jacobi - V_policy_iteration)))
+    (V_modified, policy) = modifiedPolicyIteration(mdp, 5, epsilon=1e-8)
+    print(np.max(np.abs(V_jacobi - V_modified)))
+    print(mdp.policyStringMode(policy))
+
+    # Prioritized sweeping needs fewer backups than full sweeps
+    (V_prioritized, policy, n_backups) = prioritizedValueIteration(
+        mdp, epsilon=1e-8)
+    print(np.max(np.abs(V_jacobi - V_prioritized)))
+    print(str(n_backups) + ' backups')
+
+    # After an edit, only the changed region is solved again
+    mdp.setWalls([7, 12])
+    (V_incremental, _, n_backups) = incrementalValueIteration(
+        mdp, V_jacobi, epsilon=1e-8)
+    (V_edited, _) = valueIteration(mdp, epsilon=1e-8)
+    print(np.max(np.abs(V_edited - V_incremental)))
+    print(str(n_backups) + ' backups')
+
+
 if __name__ == '__main__':
     _test_mdps()
     _test_environments()
+    _test_dynamic_programming()
@@ -0,0 +1,206 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import scipy.sparse
+
+
+def _updateHash(hasher, array):
+    """ Add the content of a dense or sparse array to a hash. """
+    if scipy.sparse.issparse(array):
+        array = scipy.sparse.csr_matrix(array)
+        hasher.update(('csr' + str(array.shape)).encode())
+        parts = [array.data, array.indices, array.indptr]
+    else:
+        parts = [np.asarray(array)]
+    for part in parts:
+        part = np.ascontiguousarray(part)
+        hasher.update((part.dtype.str + str(part.shape)).encode())
+        hasher.update(part.view(np.uint8).ravel())
+
+
+class SolutionCache:
+
+    """ On-disk cache of the values and policies computed by the solvers in
+    dynamic_programming.
+
+    Solutions are stored in a directory per MDP and per setting:
+
+        directory/<problem hash>/<settings hash>/values.npy (and policy.npy)
+
+    The problem hash covers P, R and T, the solver and its input policy. The
+    settings hash covers the discount factor and the other solver settings.
+    A solution with the same problem hash but other settings, e.g. the same
+    MDP with a different discount, is not a hit, but its values are a good
+    warm start. The least recently used solutions are removed when the cache
+    grows larger than max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes=2**30):
+        """ Open or create a solution cache.
+
+        Args:
+            directory - directory in which the solutions are stored
+            max_bytes - maximum total size of the stored solutions
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, solver, mdp, policy=None, settings=None):
+        """ Compute the key of a solve.
+
+        Args:
+            solver - name of the solver, e.g. 'valueIteration'
+            mdp - a MarkovDecisionProcess
+            policy - the policy passed to the solver, if any
+            settings - a dictionary with the other arguments of the solver
+                which change its result
+
+        Returns:
+            a tuple of two strings: the problem hash and the settings hash
+        """
+        problem = hashlib.sha1(solver.encode())
+        if mdp.isImplicit():
+            # The solvers only read the transitions through these tables
+            arrays = [mdp.transitionMatrix(), mdp.expectedRewards()]
+        else:
+            arrays = [mdp.P, mdp.R]
+        for array in arrays + [np.asarray(mdp.T, dtype=bool)]:
+            _updateHash(problem, array)
+        if policy is not None:
+            _updateHash(problem, policy)
+
+        settings = dict(settings or {}, discount=mdp.discount)
+        settings = repr(sorted(settings.items()))
+        return (problem.hexdigest(),
+                hashlib.sha1(settings.encode()).hexdigest())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[0], key[1])
+
+    def load(self, key):
+        """ Look up a stored solution.
+
+        Args:
+            key - a key returned by key()
+
+        Returns:
+            None if there is no solution for this key, otherwise a tuple with
+            the values and the policy (None if none was stored). They are
+            memory mapped copy-on-write: they are read on demand, and the
+            caller may modify them like those of a solve, without changing
+            the stored solution.
+        """
+        path = self._path(key)
+        values_file = os.path.join(path, 'values.npy')
+        if not os.path.isfile(values_file):
+            return None
+
+        # Mark the solution as recently used
+        os.utime(path, None)
+
+        values = np.load(values_file, mmap_mode='c')
+        policy_file = os.path.join(path, 'policy.npy')
+        policy = None
+        if os.path.isfile(policy_file):
+            policy = np.load(policy_file, mmap_mode='c')
+        return (values, policy)
+
+    def warmStart(self, key):
+        """ Look up the values of a solution of the same problem with other
+        settings, e.g. the same MDP with another discount factor.
+
+        Args:
+            key - a key returned by key()
+
+        Returns:
+            the values of the most recently used such solution, a numpy array
+            of size len(S) memory mapped copy-on-write, or None if there is
+            none
+        """
+        problem_path = os.path.join(self.directory, key[0])
+        if not os.path.isdir(problem_path):
+            return None
+
+        paths = [os.path.join(problem_path, name)
+                 for name in os.listdir(problem_path)]
+        paths = [path for path in paths
+                 if os.path.isfile(os.path.join(path, 'values.npy'))]
+        if not paths:
+            return None
+        path = max(paths, key=os.path.getmtime)
+        return np.load(os.path.join(path, 'values.npy'), mmap_mode='c')
+
+    def save(self, key, values, policy=None):
+        """ Store a solution, and evict old solutions if the cache is full.
+
+        Args:
+            key - a key returned by key()
+            values - the values, a numpy array of size len(S)
+            policy - (optional) the policy, a numpy array
+        """
+        path = self._path(key)
+        problem_path = os.path.dirname(path)
+        if not os.path.isdir(problem_path):
+            os.makedirs(problem_path)
+
+        # Write to a temporary directory first, so that other processes never
+        # see half a solution. The rename is atomic, and fails if another
+        # process stored a solution for the same key in the meantime: as the
+        # key determines the solution, that one is kept.
+        tmp_path = tempfile.mkdtemp(dir=problem_path, prefix='.tmp')
+        np.save(os.path.join(tmp_path, 'values.npy'), values)
+        if policy is not None:
+            np.save(os.path.join(tmp_path, 'policy.npy'), policy)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            shutil.rmtree(tmp_path)
+            if not os.path.isdir(path):
+                raise
+            os.utime(path, None)
+
+        self._evict(keep=path)
+
+    def _solutions(self):
+        """ Return a list of (last use, size, path) of the stored solutions.
+        """
+        solutions = []
+        for problem in os.listdir(self.directory):
+            problem_path = os.path.join(self.directory, problem)
+            if not os.path.isdir(problem_path):
+                continue
+            for settings in os.listdir(problem_path):
+                if settings.startswith('.tmp'):
+                    continue
+                path = os.path.join(problem_path, settings)
+                size = sum(os.path.getsize(os.path.join(path, name))
+                           for name in os.listdir(path))
+                solutions.append((os.path.getmtime(path), size, path))
+        return solutions
+
+    def _evict(self, keep=None):
+        """ Remove the least recently used solutions until the cache fits in
+        max_bytes. The solution in the directory 'keep' is never removed.
+        """
+        solutions = sorted(self._solutions())
+        total = sum(size for (_, size, _) in solutions)
+        for (_, size, path) in solutions:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            shutil.rmtree(path)
+            total -= size
+            problem_path = os.path.dirname(path)
+            if not os.listdir(problem_path):
+                os.rmdir(problem_path)
+
+    def clear(self):
+        """ Remove all stored solutions."""
+        for name in os.listdir(self.directory):
+            shutil.rmtree(os.path.join(self.directory, name))